@@ -1,7 +1,6 @@
 import os
 import streamlit as st
 import pandas as pd
-import sqlite3
 from dotenv import load_dotenv
 from datetime import datetime
 import base64
@@ -22,29 +21,50 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 
 )# Импорт обновляющих функций (без автозапуска)
-from updater import (
-    update_sales_data,
-    update_stock_data,
-    update_production_data,
-    update_purchases_data
-)
+from updater import analytics, db, ingest_inbox, rollups
+
+# Если запущен слушатель почты (python -m updater.listen), дашборд не
+# обновляет данные сам: AUTO_UPDATE=0
+AUTO_UPDATE = os.getenv("AUTO_UPDATE", "1") == "1"
 
-# Автоматическое обновление при открытии дашборда
+# Автоматическое обновление при открытии дашборда:
+# один проход по почте для всех отчётов (продажи, склад, производство, закупки)
 @st.cache_data
 def auto_update():
-    update_sales_data()
-    update_stock_data()
-    update_production_data()
-    update_purchases_data()
+    return ingest_inbox()
 
 # Вызываем один раз при старте
-auto_update()
+if AUTO_UPDATE:
+    auto_update()
 
 # Загрузка .env файла
 load_dotenv()
 
 # Получение переменных из .env
 DB_PATH = os.getenv("DB_PATH", "db.db").replace("DB_PATH=", "")  # Убираем префикс DB_PATH=
+
+# Одно соединение (WAL, общий кэш страниц) на весь процесс дашборда:
+# запросы не открывают базу заново и не ждут загрузку отчётов
+@st.cache_resource
+def get_db_connection():
+    return db.connect(DB_PATH, shared=True)
+
+DB_CONN = get_db_connection()
+
+# ANALYTICS_BACKEND=duckdb: запросы страниц идут в DuckDB по Parquet-копиям таблиц
+@st.cache_resource
+def get_analytics_connection():
+    return analytics.connect()
+
+ANALYTICS_CONN = get_analytics_connection()
+
+def query_df(sql, params=()):
+    # sales могли измениться вне загрузчика (бюджет, ручные правки):
+    # перед чтением сводок пересчитываются отмеченные триггерами срезы
+    if 'sales_by_' in sql:
+        rollups.refresh_dirty(DB_CONN)
+    return analytics.query_df(sql, params, conn=DB_CONN, duck=ANALYTICS_CONN)
+
 # COVER_IMAGE = os.getenv("COVER_IMAGE", "cover.png")
 BACKGROUND_IMAGE = os.getenv("BACKGROUND_IMAGE", "cover.png")
 
@@ -115,14 +135,11 @@ elif menu == "📋 Динамика продаж":
         <hr style='border:1px solid #eee; margin-bottom:2em;'>
     """, unsafe_allow_html=True)
 
-    conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql_query("""
-        SELECT year AS Год, month AS Месяц, type AS Тип, SUM(revenue) AS Выручка
-        FROM sales
+    df = query_df("""
+        SELECT year AS Год, month AS Месяц, type AS Тип, revenue AS Выручка
+        FROM sales_by_period
         WHERE type IN ('Факт', 'Bdg')
-        GROUP BY year, month, type
-    """, conn)
-    conn.close()
+    """)
 
     MONTH_NAMES_RU = {
         1: "Январь", 2: "Февраль", 3: "Март", 4: "Апрель",
@@ -184,22 +201,18 @@ elif menu == "📋 Динамика продаж":
         st.plotly_chart(fig, use_container_width=True)
 
         # --- Новый блок: выбор менеджера и таблица клиентов ---
-        conn = sqlite3.connect(DB_PATH)
-        df_managers = pd.read_sql_query('SELECT DISTINCT manager FROM sales WHERE manager IS NOT NULL AND manager != ""', conn)
-        conn.close()
+        df_managers = query_df("SELECT DISTINCT manager FROM sales_by_manager WHERE manager IS NOT NULL AND manager != ''")
         managers = sorted(df_managers['manager'].unique())
         selected_manager = st.selectbox('Выберите менеджера для анализа клиентов:', managers)
         if selected_manager:
             # Считаем общую сумму продаж (план и факт) по выбранному менеджеру и году
-            conn = sqlite3.connect(DB_PATH)
-            df_total = pd.read_sql_query('''
+            df_total = query_df('''
                 SELECT 
-                    SUM(CASE WHEN type = "Bdg" THEN revenue ELSE 0 END) as План,
-                    SUM(CASE WHEN type = "Факт" THEN revenue ELSE 0 END) as Факт
-                FROM sales
+                    SUM(CASE WHEN type = 'Bdg' THEN revenue ELSE 0 END) as План,
+                    SUM(CASE WHEN type = 'Факт' THEN revenue ELSE 0 END) as Факт
+                FROM sales_by_manager
                 WHERE manager = ? AND year = ?
-            ''', conn, params=(selected_manager, str(selected_year)))
-            conn.close()
+            ''', params=(selected_manager, str(selected_year)))
             total_plan = int(df_total.iloc[0]['План']) if not pd.isna(df_total.iloc[0]['План']) else 0
             total_fact = int(df_total.iloc[0]['Факт']) if not pd.isna(df_total.iloc[0]['Факт']) else 0
             st.markdown(f"""
@@ -209,21 +222,17 @@ elif menu == "📋 Динамика продаж":
                     <span style='font-size:1.2em; color:#2874A6;'>План: <b>{total_plan:,} руб.</b></span>
                 </div>
             """, unsafe_allow_html=True)
-            conn = sqlite3.connect(DB_PATH)
-            df_clients = pd.read_sql_query(f'''
+            df_clients = query_df(f'''
                 SELECT client_code,
                        SUM(CASE WHEN type = 'Факт' THEN revenue ELSE 0 END) as Факт
-                FROM sales
+                FROM sales_by_client
                 WHERE manager = ? AND year = ?
                 GROUP BY client_code
                 HAVING Факт > 0
                 ORDER BY Факт DESC
-            ''', conn, params=(selected_manager, str(selected_year)))
-            conn.close()
+            ''', params=(selected_manager, str(selected_year)))
             if not df_clients.empty:
-                conn = sqlite3.connect(DB_PATH)
-                df_names = pd.read_sql_query('SELECT code, name FROM clients', conn)
-                conn.close()
+                df_names = query_df('SELECT code, name FROM clients')
                 df_clients_merged = df_clients.merge(df_names, left_on='client_code', right_on='code', how='left')
                 if not df_clients_merged['name'].isnull().all():
                     df_clients_merged = df_clients_merged[['client_code', 'name', 'Факт']]
@@ -235,19 +244,16 @@ elif menu == "📋 Динамика продаж":
                         for idx, row in df_clients_merged.iterrows():
                             expander_label = f"{row['Клиент']} — {int(row['Факт']):,} руб."
                             with st.expander(label=expander_label, expanded=False):
-                                conn = sqlite3.connect(DB_PATH)
-                                df_products = pd.read_sql_query(
+                                df_products = query_df(
                                     '''
-                                    SELECT p.code_ap, SUM(s.revenue) as Сумма_продаж
-                                    FROM sales s
-                                    LEFT JOIN products p ON s.product_code = p.code
-                                    WHERE s.client_code = ? AND s.manager = ? AND s.year = ?
-                                    GROUP BY p.code_ap
+                                    SELECT code_ap, SUM(revenue) as Сумма_продаж
+                                    FROM sales_by_client_product
+                                    WHERE client_code = ? AND manager = ? AND year = ?
+                                    GROUP BY code_ap
                                     ORDER BY Сумма_продаж DESC
                                     ''',
-                                    conn, params=(row['client_code'], selected_manager, str(selected_year))
+                                    params=(row['client_code'], selected_manager, str(selected_year))
                                 )
-                                conn.close()
                                 if not df_products.empty:
                                     st.dataframe(df_products.rename(
                                         columns={'code_ap': 'Код продукции', 'Сумма_продаж': 'Сумма продаж'}
@@ -265,19 +271,16 @@ elif menu == "📋 Динамика продаж":
                         for idx, row in df_clients_simple.iterrows():
                             expander_label = f"{row['Клиент']} — {int(row['Факт']):,} руб."
                             with st.expander(label=expander_label, expanded=False):
-                                conn = sqlite3.connect(DB_PATH)
-                                df_products = pd.read_sql_query(
+                                df_products = query_df(
                                     '''
-                                    SELECT p.code_ap, SUM(s.revenue) as Сумма_продаж
-                                    FROM sales s
-                                    LEFT JOIN products p ON s.product_code = p.code
-                                    WHERE s.client_code = ? AND s.manager = ? AND s.year = ?
-                                    GROUP BY p.code_ap
+                                    SELECT code_ap, SUM(revenue) as Сумма_продаж
+                                    FROM sales_by_client_product
+                                    WHERE client_code = ? AND manager = ? AND year = ?
+                                    GROUP BY code_ap
                                     ORDER BY Сумма_продаж DESC
                                     ''',
-                                    conn, params=(row['Клиент'], selected_manager, str(selected_year))
+                                    params=(row['Клиент'], selected_manager, str(selected_year))
                                 )
-                                conn.close()
                                 if not df_products.empty:
                                     st.dataframe(df_products.rename(
                                         columns={'code_ap': 'Код продукции', 'Сумма_продаж': 'Сумма продаж'}
@@ -316,35 +319,29 @@ elif menu == "📦 Складские остатки":
         <hr style='border:1px solid #eee; margin-bottom:2em;'>
     """, unsafe_allow_html=True)
 
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        dates_df = pd.read_sql_query("SELECT DISTINCT report_date FROM stock_balance ORDER BY report_date DESC", conn)
-        conn.close()
-
-        # Преобразуем дату в человекочитаемый формат
-        dates_df['report_date'] = pd.to_datetime(dates_df['report_date'])
-        dates_df['label'] = dates_df['report_date'].dt.strftime('%-d %B %Y').str.capitalize()
-        date_mapping = dict(zip(dates_df['label'], dates_df['report_date']))
-
-        # Список дат для selectbox
-        selected_label = st.selectbox("Выберите дату отчета:", list(date_mapping.keys()))
-        selected_date = date_mapping[selected_label]
-
-        st.info(f"📅 Отображаются данные за дату: {selected_label}")
-
-        # Теперь выполняем запрос с выбранной датой
-        conn = sqlite3.connect(DB_PATH)
-        df_all = pd.read_sql_query(
-            """
-            SELECT warehouse as Склад, nomenclature_type as Группа,
-                   article as Артикул, quantity as Количество, value as Сумма
-            FROM stock_balance
-            WHERE report_date = ?
-            """,
-            conn, params=(selected_date.strftime('%Y-%m-%d'),)
-        )
-    finally:
-        conn.close()
+    dates_df = query_df("SELECT DISTINCT report_date FROM stock_balance ORDER BY report_date DESC")
+
+    # Преобразуем дату в человекочитаемый формат
+    dates_df['report_date'] = pd.to_datetime(dates_df['report_date'])
+    dates_df['label'] = dates_df['report_date'].dt.strftime('%-d %B %Y').str.capitalize()
+    date_mapping = dict(zip(dates_df['label'], dates_df['report_date']))
+
+    # Список дат для selectbox
+    selected_label = st.selectbox("Выберите дату отчета:", list(date_mapping.keys()))
+    selected_date = date_mapping[selected_label]
+
+    st.info(f"📅 Отображаются данные за дату: {selected_label}")
+
+    # Теперь выполняем запрос с выбранной датой
+    df_all = query_df(
+        """
+        SELECT warehouse as Склад, nomenclature_type as Группа,
+               article as Артикул, quantity as Количество, value as Сумма
+        FROM stock_balance
+        WHERE report_date = ?
+        """,
+        params=(selected_date.strftime('%Y-%m-%d'),)
+    )
 
     total_qty_all = df_all['Количество'].sum()
     total_val_all = df_all['Сумма'].sum()
@@ -410,22 +407,21 @@ elif menu == "📊 Производство":
         <hr style='border:1px solid #eee; margin-bottom:2em;'>
     """, unsafe_allow_html=True)
 
-    if update_production_data():
-        st.success("Данные по производству обновлены")
-    else:
-        st.info("Нет новых данных или ошибка при обновлении")
+    if AUTO_UPDATE:
+        if update_production_data():
+            st.success("Данные по производству обновлены")
+        else:
+            st.info("Нет новых данных или ошибка при обновлении")
 
     # Подключение к БД
-    conn = sqlite3.connect(DB_PATH)
-    df_prod = pd.read_sql_query("""
+    df_prod = query_df("""
         SELECT article AS Артикул,
                nomenclature_desc AS Описание,
                plan AS План,
                fact AS Факт
         FROM production_exec
         WHERE LOWER(article) != 'итого'
-    """, conn)
-    conn.close()
+    """)
 
     if df_prod.empty:
         st.warning("Нет данных по исполнению производства.")
@@ -476,16 +472,19 @@ elif menu == "🌍 Логистика":
 elif menu == "Закупки":
     st.markdown("<h1 style='text-align:center;'>📦 Закупки</h1>", unsafe_allow_html=True)
 
-    conn = sqlite3.connect(DB_PATH)
     try:
-        df = pd.read_sql_query("SELECT * FROM purchases ORDER BY report_date DESC", conn)
-        if df.empty:
+        dates_df = query_df("SELECT DISTINCT report_date FROM purchases ORDER BY report_date DESC")
+        if dates_df.empty:
             st.info("Нет данных по закупкам.")
         else:
-            # Фильтр по дате
-            available_dates = sorted(df['report_date'].unique(), reverse=True)
+            # Фильтр по дате: читаются только закупки выбранного отчёта
+            available_dates = list(dates_df['report_date'])
             selected_date = st.selectbox("Выберите дату отчета:", available_dates)
-            df_filtered = df[df['report_date'] == selected_date]
+            df_filtered = query_df("""
+                SELECT supplier, product, quantity, price_per_unit, total, total_with_vat
+                FROM purchases
+                WHERE report_date = ?
+            """, params=(selected_date,))
             st.info(
             f"Поставщиков: {df_filtered['supplier'].nunique()}. "
             f"Сумма закупок с НДС: {df_filtered['total_with_vat'].sum():,.0f} руб."
@@ -510,6 +509,4 @@ elif menu == "Закупки":
                         use_container_width=True
                     )
     except Exception as e:
-        st.error(f"Ошибка при загрузке закупок: {e}")
-    finally:
-        conn.close()
\ No newline at end of file
+        st.error(f"Ошибка при загрузке закупок: {e}")
\ No newline at end of file
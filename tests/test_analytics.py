@@ -0,0 +1,65 @@
+"""DuckDB читает таблицу из Parquet только после полной выгрузки"""
+import pandas as pd
+import pytest
+
+duckdb = pytest.importorskip('duckdb')
+
+from updater import analytics, db
+
+SALES = pd.DataFrame({
+    'year': [2024, 2024, 2025],
+    'month': [1, 2, 1],
+    'type': ['Факт', 'Факт', 'Факт'],
+    'client_code': ['К-1', 'К-2', 'К-1'],
+    'manager': ['Иванов', 'Петров', 'Иванов'],
+    'revenue': [100.0, 200.0, 300.0],
+})
+SQL = "SELECT year, SUM(revenue) AS revenue FROM sales GROUP BY year ORDER BY year"
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = db.connect(str(tmp_path / 'db.db'))
+    db.insert_df(conn, 'sales', SALES)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def duck():
+    duck = duckdb.connect()
+    yield duck
+    duck.close()
+
+
+def test_partial_export_falls_back_to_sqlite(conn, duck, tmp_path):
+    parquet_dir = str(tmp_path / 'parquet')
+    # дозапись одного раздела до первой полной выгрузки
+    analytics.export_partitions('sales', [(2025, 1, 'Факт')], conn, parquet_dir)
+    assert not analytics.is_complete('sales', parquet_dir)
+    assert 'sales' not in analytics._available(duck, parquet_dir)
+    df = analytics.query_df(SQL, conn=conn, duck=duck, parquet_dir=parquet_dir)
+    assert df['revenue'].tolist() == [300.0, 300.0]
+
+    assert analytics.export_table('sales', conn, parquet_dir) == 3
+    assert analytics.is_complete('sales', parquet_dir)
+    assert {'sales', 'sales_by_period'} <= analytics._available(duck, parquet_dir)
+    df = analytics.query_df(SQL, conn=conn, duck=duck, parquet_dir=parquet_dir)
+    assert df['revenue'].tolist() == [300.0, 300.0]
+
+
+def test_failed_store_drops_manifest(conn, tmp_path, monkeypatch):
+    parquet_dir = str(tmp_path / 'parquet')
+    analytics.export_table('sales', conn, parquet_dir)
+    monkeypatch.setattr(analytics, 'ENABLED', True)
+    monkeypatch.setattr(analytics.db, 'get_connection', lambda path=None: conn)
+
+    analytics.store('sales', [(2024, 1, 'Факт')], parquet_dir=parquet_dir)
+    assert analytics.is_complete('sales', parquet_dir)
+
+    def broken(*args, **kwargs):
+        raise OSError('диск заполнен')
+
+    monkeypatch.setattr(analytics, 'export_partitions', broken)
+    analytics.store('sales', [(2024, 1, 'Факт')], parquet_dir=parquet_dir)
+    assert not analytics.is_complete('sales', parquet_dir)
@@ -0,0 +1,61 @@
+"""Все движки iter_report отдают те же значения ячеек, что pd.read_excel"""
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from updater import excel
+
+COLUMNS = ['article', 'price', 'name', 'date', 'flag']
+ROWS = [
+    COLUMNS,
+    [12345, 1.5, 'Кабель', None, True],
+    [0, -3, '12', datetime(2025, 1, 2), False],
+]
+LAYOUT = excel.Layout(columns=COLUMNS, min_row=2)
+
+
+@pytest.fixture
+def xlsx(tmp_path):
+    openpyxl = pytest.importorskip('openpyxl')
+    wb = openpyxl.Workbook()
+    for row in ROWS:
+        wb.active.append(row)
+    path = str(tmp_path / 'report.xlsx')
+    wb.save(path)
+    return path
+
+
+@pytest.fixture
+def xls(tmp_path):
+    xlwt = pytest.importorskip('xlwt')
+    wb = xlwt.Workbook()
+    sheet = wb.add_sheet('Лист1')
+    date_style = xlwt.easyxf(num_format_str='DD.MM.YYYY')
+    for i, row in enumerate(ROWS):
+        for j, value in enumerate(row):
+            if value is not None:
+                sheet.write(i, j, value, date_style if isinstance(value, datetime) else xlwt.Style.default_style)
+    path = str(tmp_path / 'report.xls')
+    wb.save(path)
+    return path
+
+
+@pytest.mark.parametrize('engine', ['calamine', 'openpyxl'])
+def test_xlsx_engines_match_read_excel(xlsx, engine):
+    if engine not in excel.available_engines('xlsx'):
+        pytest.skip(f"движок {engine} не установлен")
+    expected = pd.read_excel(xlsx, header=None, skiprows=1, names=COLUMNS, engine='openpyxl')
+    actual = pd.concat(excel.iter_report(xlsx, LAYOUT, engine=engine), ignore_index=True)
+    pd.testing.assert_frame_equal(actual, expected)
+    # артикул — целое число, а не 12345.0
+    assert [type(v) for v in actual['article'].tolist()] == [int, int]
+
+
+@pytest.mark.parametrize('engine', ['calamine', 'xlrd'])
+def test_xls_engines_match(xls, xlsx, engine):
+    if engine not in excel.available_engines('xls'):
+        pytest.skip(f"движок {engine} не установлен")
+    expected = pd.concat(excel.iter_report(xlsx, LAYOUT, engine='openpyxl'), ignore_index=True)
+    actual = pd.concat(excel.iter_report(xls, LAYOUT, engine=engine), ignore_index=True)
+    pd.testing.assert_frame_equal(actual, expected)
@@ -0,0 +1,82 @@
+"""Поиск письма и вложения Gmail: число запросов к API и raw-режим"""
+import base64
+import json
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpMockSequence
+
+from updater import mail
+
+SUBJECT = 'Остатки по складам'
+ATTACHMENT = b'PK\x03\x04 excel bytes'
+
+
+def message(message_id, subject, parts):
+    return {
+        'id': message_id,
+        'payload': {'headers': [{'name': 'Subject', 'value': subject}], 'parts': parts},
+    }
+
+
+def batch_response(messages):
+    """Ответ batch-запроса: multipart/mixed с ответом на каждое письмо"""
+    boundary = 'batch_boundary'
+    parts = [
+        f"--{boundary}\r\n"
+        "Content-Type: application/http\r\n"
+        f"Content-ID: <response-base + {item['id']}>\r\n\r\n"
+        "HTTP/1.1 200 OK\r\n"
+        "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+        f"{json.dumps(item)}\r\n"
+        for item in messages
+    ]
+    headers = {'status': '200', 'content-type': f'multipart/mixed; boundary={boundary}'}
+    return headers, ''.join(parts) + f"--{boundary}--\r\n"
+
+
+@pytest.fixture
+def http():
+    excel_part = {
+        'partId': '1', 'filename': 'остатки.xlsx',
+        'mimeType': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'body': {'attachmentId': 'att-1', 'size': len(ATTACHMENT)},
+    }
+    text_part = {'partId': '0', 'filename': '', 'mimeType': 'text/plain', 'body': {'size': 10}}
+    return HttpMockSequence([
+        ({'status': '200'}, json.dumps({'messages': [{'id': 'm1'}, {'id': 'm2'}, {'id': 'm3'}]})),
+        batch_response([
+            message('m1', 'Продажи', []),
+            message('m2', f'{SUBJECT} на 01.03.2025', [text_part, {'partId': '2', 'parts': [excel_part]}]),
+            message('m3', f'{SUBJECT} на 28.02.2025', []),
+        ]),
+        ({'status': '200'}, json.dumps({'data': base64.urlsafe_b64encode(ATTACHMENT).decode()})),
+    ])
+
+
+def test_raw_attachment_in_three_round_trips(http):
+    service = build('gmail', 'v1', http=http, static_discovery=True)
+    data, subject = mail.get_file_by_mail_id(service, SUBJECT, raw=True)
+
+    assert isinstance(data, bytes)
+    assert data == ATTACHMENT
+    assert subject == f'{SUBJECT} на 01.03.2025'
+    # список писем, один batch с заголовками всех писем, вложение
+    uris = [uri for uri, *_ in http.request_sequence]
+    assert len(uris) == 3
+    assert '/messages?' in uris[0]
+    assert '/batch' in uris[1]
+    assert '/messages/m2/attachments/att-1' in uris[2]
+
+
+def test_batch_requests_only_structure(http):
+    service = build('gmail', 'v1', http=http, static_discovery=True)
+    mail.get_mail_id(service, SUBJECT)
+
+    batch_body = http.request_sequence[1][2]
+    batch_body = batch_body.decode() if isinstance(batch_body, bytes) else batch_body
+    # три письма в одном batch, с маской полей без содержимого частей
+    assert batch_body.count('GET /gmail/v1/users/me/messages/') == 3
+    assert 'fields=' in batch_body
@@ -0,0 +1,48 @@
+"""prepare_df против построчной версии до векторизации (updater.bench.prepare_df_loop)"""
+import pandas as pd
+import pytest
+
+from updater.bench import prepare_df_loop, synthetic_sales_report
+from updater.process_report import prepare_df
+
+# строка листа с именами колонок; за ней сразу заголовок первой даты
+COLUMNS_ROW = 1
+
+
+def report(days=4):
+    return synthetic_sales_report(50, clients=5, products=5, days=days)
+
+
+def date_headers(sheet):
+    """Номера строк листа с датой в первой колонке"""
+    first = sheet.iloc[:, 0].astype(str)
+    return list(sheet.index[first.str.match(r'\d\d\.\d\d\.\d{4}$')])
+
+
+def assert_same(sheet):
+    expected = prepare_df_loop(sheet.copy())
+    actual = prepare_df(sheet.copy())
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+    return actual
+
+
+def test_first_row_is_date_header():
+    sheet = report()
+    assert date_headers(sheet)[0] == COLUMNS_ROW + 1
+    df = assert_same(sheet)
+    assert len(df) == 50
+    assert (df["Клиент.Наименование"] != 0).all()
+    assert set(df["Дата"]) == {'01.01.2024', '02.01.2024', '03.01.2024', '04.01.2024'}
+    assert set(df["Год"]) == {2024}
+    assert set(df["Месяц"]) == {1}
+
+
+@pytest.mark.parametrize('block', [0, 1, 3])
+def test_rows_without_date_are_dropped(block):
+    sheet = report()
+    headers = date_headers(sheet) + [len(sheet)]
+    sheet.iloc[headers[block], 0] = None
+    df = assert_same(sheet)
+    dropped = headers[block + 1] - headers[block] - 1
+    assert len(df) == 50 - dropped
+    assert (df["Дата"] != 0).all()
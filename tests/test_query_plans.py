@@ -0,0 +1,68 @@
+"""Запросы дашборда на свежей базе читают свои индексы, а не всю таблицу"""
+import runpy
+
+import pytest
+
+from updater import db, migrations
+
+# Запрос -> индекс, по которому он должен выполняться
+EXPECTED_INDEXES = {
+    'Динамика продаж': 'idx_sales_by_period_slice',
+    'Менеджеры': 'sqlite_autoindex_sales_by_manager_1',
+    'Итоги менеджера': 'sqlite_autoindex_sales_by_manager_1',
+    'Клиенты менеджера': 'sqlite_autoindex_sales_by_client_1',
+    'Товары клиента': 'sqlite_autoindex_sales_by_client_product_1',
+    'Срез продаж': 'idx_sales_type_period',
+    'Даты остатков': 'idx_stock_balance_date',
+    'Остатки на дату': 'idx_stock_balance_date',
+    'Закупки': 'idx_purchases_date',
+}
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'db.db')
+
+
+@pytest.fixture
+def conn(db_path):
+    # db.connect применяет все миграции
+    conn = db.connect(db_path)
+    yield conn
+    conn.close()
+
+
+def test_schema_is_current(conn):
+    assert migrations.schema_version(conn) == len(migrations.MIGRATIONS)
+
+
+def test_every_query_has_expected_index():
+    assert set(EXPECTED_INDEXES) == set(migrations.DASHBOARD_QUERIES)
+
+
+@pytest.mark.parametrize('name', list(EXPECTED_INDEXES))
+def test_query_uses_index(conn, name):
+    sql, params = migrations.DASHBOARD_QUERIES[name]
+    plan = migrations.explain(sql, params, conn)
+    assert any(f"INDEX {EXPECTED_INDEXES[name]}" in line for line in plan), plan
+    assert not [line for line in plan if migrations.FULL_SCAN_RE.match(line)], plan
+
+
+def test_no_full_scans(conn):
+    assert migrations.check_query_plans(conn) == {}
+
+
+def test_main_fails_on_regression(db_path, conn):
+    assert migrations.main([db_path]) == 0
+    conn.execute("DROP INDEX idx_stock_balance_date")
+    assert set(migrations.check_query_plans(conn)) == {'Даты остатков', 'Остатки на дату'}
+    assert migrations.main([db_path]) == 1
+
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+def test_module_exit_code(db_path, conn, monkeypatch):
+    conn.execute("DROP INDEX idx_purchases_date")
+    monkeypatch.setattr('sys.argv', ['updater.migrations', db_path])
+    with pytest.raises(SystemExit) as exit_info:
+        runpy.run_module('updater.migrations', run_name='__main__')
+    assert exit_info.value.code == 1
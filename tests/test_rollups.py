@@ -0,0 +1,74 @@
+"""Сводки продаж совпадают с агрегатами sales и после записей вне загрузчика"""
+import pandas as pd
+import pytest
+
+from updater import db, rollups
+
+SALES = pd.DataFrame({
+    'year': [2024, 2024, 2025, 2025],
+    'month': [1, 2, 1, 1],
+    'type': ['Факт', 'Факт', 'Факт', 'Факт'],
+    'client_code': ['К-1', 'К-2', 'К-1', 'К-1'],
+    'manager': ['Иванов', 'Петров', 'Иванов', 'Иванов'],
+    'product_code': ['Н-1', 'Н-2', 'Н-1', 'Н-3'],
+    'product_name': ['Товар 1', 'Товар 2', 'Товар 1', 'Товар 3'],
+    'revenue': [100.0, 200.0, 300.0, 50.0],
+})
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = db.connect(str(tmp_path / 'db.db'))
+    with db.transaction(conn, immediate=True):
+        db.insert_df(conn, 'sales', SALES)
+        rollups.refresh(conn, [(2024, 1, 'Факт'), (2025, 1, 'Факт')])
+    yield conn
+    conn.close()
+
+
+def assert_rollups_match(conn):
+    for table, (keys, _) in rollups.ROLLUPS.items():
+        if 'code_ap' in keys:
+            continue
+        columns = ', '.join(keys)
+        expected = db.query_all(
+            f"SELECT {columns}, SUM(revenue) FROM sales WHERE type IS NOT NULL "
+            f"GROUP BY {columns} ORDER BY {columns}", conn=conn
+        )
+        actual = db.query_all(f"SELECT {columns}, revenue FROM {table} ORDER BY {columns}", conn=conn)
+        assert actual == expected, table
+
+
+def test_loader_refresh_leaves_nothing_dirty(conn):
+    assert_rollups_match(conn)
+    assert db.query_all(f"SELECT * FROM {rollups.DIRTY_TABLE}", conn=conn) == []
+    assert rollups.refresh_dirty(conn) == 0
+
+
+def test_writes_outside_loader_are_refreshed(conn):
+    # бюджет и ручные правки пишутся в sales напрямую
+    db.execute(
+        "INSERT INTO sales (year, month, type, client_code, manager, revenue) "
+        "VALUES (2025, 1, 'Bdg', 'К-1', 'Иванов', 1000)", conn=conn
+    )
+    db.execute("UPDATE sales SET revenue = 250, comment = 'правка' WHERE client_code = 'К-2'", conn=conn)
+    db.execute("DELETE FROM sales WHERE product_code = 'Н-3'", conn=conn)
+    assert set(db.query_all(f"SELECT type, year FROM {rollups.DIRTY_TABLE}", conn=conn)) == {
+        ('Bdg', 2025), ('Факт', 2024), ('Факт', 2025)
+    }
+
+    assert rollups.refresh_dirty(conn) == 3
+    assert_rollups_match(conn)
+    assert db.query_all(f"SELECT * FROM {rollups.DIRTY_TABLE}", conn=conn) == []
+
+
+def test_moving_rows_between_slices_refreshes_both(conn):
+    db.execute("UPDATE sales SET year = 2026 WHERE year = 2024", conn=conn)
+    rollups.refresh_dirty(conn)
+    assert_rollups_match(conn)
+    assert db.query_all("SELECT DISTINCT year FROM sales_by_period ORDER BY year", conn=conn) == [(2025,), (2026,)]
+
+
+def test_comment_only_update_does_not_mark(conn):
+    db.execute("UPDATE sales SET comment = 'проверено'", conn=conn)
+    assert db.query_all(f"SELECT * FROM {rollups.DIRTY_TABLE}", conn=conn) == []
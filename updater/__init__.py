@@ -1,3 +1,4 @@
+from .inbox import ingest_inbox, report_handler
 from .sales_updater import update_sales_data
 from .stock_updater import update_stock_data
 from .production_updater import update_production_data
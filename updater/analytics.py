@@ -0,0 +1,237 @@
+"""Аналитический режим: Parquet-копии таблиц и запросы дашборда через DuckDB.
+
+При ANALYTICS_BACKEND=duckdb загрузчики после записи в SQLite выгружают
+затронутые разделы в PARQUET_DIR (файл на раздел), а query_df() выполняет
+запросы DuckDB по этим файлам. Запросы к таблицам без Parquet-копии
+(clients, products, сводка товаров клиента) по-прежнему идут в SQLite.
+Таблица читается из Parquet, только если её копия полная: после полной
+выгрузки в каталоге таблицы лежит манифест (MANIFEST), ошибка дозаписи
+раздела его удаляет. Нужен пакет duckdb; без него режим выключается.
+Выгрузка всех данных существующей базы:
+
+    python -m updater.analytics
+"""
+import os
+import re
+import glob
+import json
+import hashlib
+import logging
+import threading
+import importlib.util
+from datetime import datetime
+from dotenv import load_dotenv
+
+from updater import db, rollups
+
+load_dotenv()
+
+DB_PATH = os.getenv("DB_PATH", "db.db")
+# sqlite — все запросы к SQLite; duckdb — Parquet-копии и запросы через DuckDB
+ANALYTICS_BACKEND = os.getenv("ANALYTICS_BACKEND", "sqlite")
+PARQUET_DIR = os.getenv("PARQUET_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "parquet"))
+
+if ANALYTICS_BACKEND == 'duckdb' and importlib.util.find_spec('duckdb') is None:
+    logging.warning("ANALYTICS_BACKEND=duckdb, но пакет duckdb не установлен: запросы идут в SQLite")
+    ANALYTICS_BACKEND = 'sqlite'
+ENABLED = ANALYTICS_BACKEND == 'duckdb'
+
+# Таблица -> колонки раздела, как их заменяют загрузчики (пустой список — вся таблица)
+DATASETS = {
+    'sales': ['year', 'month', 'type'],
+    'stock_balance': ['report_date'],
+    'purchases': ['report_date'],
+    'production_exec': [],
+}
+
+# Тип DuckDB по объявленному типу колонки SQLite, остальные — VARCHAR
+DUCKDB_TYPES = {'INTEGER': 'BIGINT', 'REAL': 'DOUBLE'}
+
+TABLE_RE = re.compile(r'(?:FROM|JOIN)\s+(\w+)', re.IGNORECASE)
+
+# Отметка полной выгрузки таблицы: без неё запросы к таблице идут в SQLite
+MANIFEST = '_manifest.json'
+
+_views_lock = threading.Lock()
+
+
+def _quote(path):
+    return path.replace("'", "''")
+
+
+def _partition_path(parquet_dir, table, key):
+    """Файл раздела: читаемое имя из значений ключа; хэш различает ключи,
+    которые после замены символов дают одно имя"""
+    text = '\x1f'.join(str(value) for value in key)
+    name = '_'.join(re.sub(r'\W+', '_', str(value)).strip('_') for value in key) or 'all'
+    digest = hashlib.sha1(text.encode()).hexdigest()[:8]
+    return os.path.join(parquet_dir, table, f"{name}-{digest}.parquet")
+
+
+# ------------------ Выгрузка ------------------
+def export_partitions(table, partitions=None, conn=None, parquet_dir=PARQUET_DIR):
+    """Перезаписывает Parquet-файлы разделов таблицы по текущим данным SQLite.
+
+    partitions — значения колонок раздела из DATASETS[table]; для таблиц без
+    разделов выгружается вся таблица. Файл пишется рядом и подменяется
+    os.replace, чтобы запросы не видели недописанный файл. Возвращает
+    список записанных файлов.
+    """
+    import duckdb
+
+    conn = conn or db.get_connection()
+    columns = DATASETS[table]
+    partitions = list(partitions) if columns else [()]
+    types = {
+        name: DUCKDB_TYPES.get(declared.upper(), 'VARCHAR')
+        for _, name, declared, *_ in db.query_all(f"PRAGMA table_info({table})", conn=conn)
+    }
+    select = ', '.join(f'CAST("{name}" AS {type_}) AS "{name}"' for name, type_ in types.items())
+    where = ' AND '.join(f"{column} = ?" for column in columns) or '1'
+
+    os.makedirs(os.path.join(parquet_dir, table), exist_ok=True)
+    duck = duckdb.connect()
+    written = []
+    try:
+        for key in partitions:
+            path = _partition_path(parquet_dir, table, key)
+            df = db.query_df(f"SELECT * FROM {table} WHERE {where}", key, conn)
+            if df.empty:
+                # раздел удалён целиком
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            duck.register('part', df)
+            duck.execute(f"COPY (SELECT {select} FROM part) TO '{_quote(path + '.tmp')}' (FORMAT PARQUET)")
+            duck.unregister('part')
+            os.replace(path + '.tmp', path)
+            written.append(path)
+    finally:
+        duck.close()
+    return written
+
+
+def _manifest_path(parquet_dir, table):
+    return os.path.join(parquet_dir, table, MANIFEST)
+
+
+def is_complete(table, parquet_dir=PARQUET_DIR):
+    """Есть ли полная Parquet-копия таблицы (манифест последней полной выгрузки)"""
+    return os.path.exists(_manifest_path(parquet_dir, table))
+
+
+def _drop_manifest(table, parquet_dir):
+    try:
+        os.remove(_manifest_path(parquet_dir, table))
+    except FileNotFoundError:
+        pass
+
+
+def export_table(table, conn=None, parquet_dir=PARQUET_DIR):
+    """Полная выгрузка таблицы: все разделы, лишние файлы удаляются.
+
+    Манифест снимается в начале и пишется последним, поэтому прерванная
+    выгрузка не считается полной.
+    """
+    conn = conn or db.get_connection()
+    _drop_manifest(table, parquet_dir)
+    columns = DATASETS[table]
+    partitions = db.query_all(f"SELECT DISTINCT {', '.join(columns)} FROM {table}", conn=conn) if columns else None
+    written = set(export_partitions(table, partitions, conn, parquet_dir))
+    for path in glob.glob(os.path.join(parquet_dir, table, '*.parquet')):
+        if path not in written:
+            os.remove(path)
+    manifest = _manifest_path(parquet_dir, table)
+    with open(manifest + '.tmp', 'w') as f:
+        json.dump({
+            'table': table,
+            'files': sorted(os.path.basename(path) for path in written),
+            'exported_at': datetime.now().isoformat(),
+        }, f, ensure_ascii=False)
+    os.replace(manifest + '.tmp', manifest)
+    return len(written)
+
+
+def store(table, partitions=None, db_path=DB_PATH, parquet_dir=PARQUET_DIR):
+    """Выгрузка разделов после загрузки в SQLite, если включён режим duckdb.
+
+    Ошибка выгрузки не отменяет загрузку: данные в SQLite уже записаны.
+    Копия таблицы перестаёт считаться полной (запросы к ней идут в SQLite),
+    пока её не восстановит `python -m updater.analytics`.
+    """
+    if not ENABLED:
+        return
+    try:
+        conn = db.get_connection(db_path)
+        if DATASETS[table]:
+            export_partitions(table, partitions, conn, parquet_dir)
+        else:
+            # таблица без разделов выгружается целиком — это полная выгрузка
+            export_table(table, conn, parquet_dir)
+    except Exception as e:
+        _drop_manifest(table, parquet_dir)
+        logging.error(f"❌ Не удалось выгрузить {table} в Parquet: {e}")
+
+
+# ------------------ Запросы ------------------
+def connect():
+    """Соединение DuckDB для дашборда (None, если режим выключен)"""
+    if not ENABLED:
+        return None
+    import duckdb
+
+    return duckdb.connect()
+
+
+def _available(duck, parquet_dir):
+    """Таблицы и сводки, которые DuckDB может читать из Parquet.
+
+    Таблица доступна, только если её копия полная (есть манифест): иначе
+    дашборд молча показал бы часть истории. Представления создаются при
+    первом обращении к полной копии.
+    Сводки продаж — представления над sales с теми же колонками, что у
+    таблиц updater.rollups (кроме тех, что требуют справочников).
+    """
+    names = set()
+    with _views_lock:
+        views = {row[0] for row in duck.execute("SELECT view_name FROM duckdb_views() WHERE NOT internal").fetchall()}
+        for table in DATASETS:
+            pattern = os.path.join(parquet_dir, table, '*.parquet')
+            if not is_complete(table, parquet_dir) or not glob.glob(pattern):
+                continue
+            if table not in views:
+                duck.execute(f"CREATE VIEW {table} AS SELECT * FROM read_parquet('{_quote(pattern)}')")
+            names.add(table)
+        if 'sales' not in names:
+            return names
+        sales_columns = None
+        for table, (keys, _) in rollups.ROLLUPS.items():
+            if table not in views:
+                if sales_columns is None:
+                    sales_columns = {row[0] for row in duck.execute("DESCRIBE sales").fetchall()}
+                if not set(keys) <= sales_columns:
+                    continue
+                duck.execute(
+                    f"CREATE VIEW {table} AS SELECT {', '.join(keys)}, SUM(revenue) AS revenue "
+                    f"FROM sales GROUP BY {', '.join(keys)}"
+                )
+            names.add(table)
+    return names
+
+
+def query_df(sql, params=(), conn=None, duck=None, parquet_dir=PARQUET_DIR):
+    """Запрос дашборда: через DuckDB, если все его таблицы есть в Parquet, иначе SQLite"""
+    tables = set(TABLE_RE.findall(sql))
+    if duck is None or not tables <= _available(duck, parquet_dir):
+        return db.query_df(sql, params, conn)
+    cursor = duck.cursor()
+    try:
+        return cursor.execute(sql, list(params)).df()
+    finally:
+        cursor.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    for name in DATASETS:
+        logging.info(f"📦 {name}: {export_table(name)} файлов в {os.path.join(PARQUET_DIR, name)}")
@@ -0,0 +1,365 @@
+"""Замеры и сверка ускоренных функций загрузки на синтетических данных:
+
+    python -m updater.bench <замер> [строк]
+
+Каждый замер сравнивает результат с эталонной (прежней) реализацией и
+печатает время обеих. Без аргументов выводит список замеров.
+"""
+import os
+import sys
+import time
+import logging
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from updater.const import CLIENT_COLS, PRODUCT_COLS, SALES_COLS
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+BENCHMARKS = {}
+
+
+def benchmark(name, rows):
+    def register(fn):
+        BENCHMARKS[name] = (fn, rows)
+        return fn
+    return register
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def traced_peak(fn, *args):
+    """Пик памяти, выделенной во время вызова (tracemalloc), в байтах"""
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def report(name, new_seconds, old_seconds):
+    logging.info(
+        f"⏱️ {name}: было {old_seconds:.2f} с, стало {new_seconds:.2f} с "
+        f"(в {old_seconds / max(new_seconds, 1e-9):.1f} раз быстрее)"
+    )
+
+
+# ------------------ Синтетические отчёты ------------------
+SALES_REPORT_COLS = list(dict.fromkeys(
+    CLIENT_COLS + PRODUCT_COLS + [
+        "Клиент.Основной менеджер", "Количество", "Выручка", "Выручка с НДС", "Скидка"
+    ]
+))
+
+
+def synthetic_sales_report(rows, clients=5000, products=20000, days=60, seed=0):
+    """Лист отчёта о продажах в виде, как его читает read_report().
+
+    Шапка отчёта, строка с именами колонок, затем блоки по датам: строка с
+    датой в первой колонке и пустым наименованием клиента, за ней строки
+    продаж.
+    """
+    rng = np.random.default_rng(seed)
+    width = len(SALES_REPORT_COLS)
+    col = {name: i for i, name in enumerate(SALES_REPORT_COLS)}
+
+    data = np.full((rows, width), None, dtype=object)
+    client = rng.integers(0, clients, rows)
+    product = rng.integers(0, products, rows)
+    data[:, col["Клиент.Код"]] = np.char.add('К-', client.astype(str))
+    data[:, col["Клиент.Наименование"]] = np.char.add('ООО Клиент ', client.astype(str))
+    data[:, col["Клиент.Головное предприятие.Наименование"]] = '1.2. КЛИЕНТЫ В РАБОТЕ'
+    data[:, col["Клиент.Юр/Физлицо"]] = 'Юр. лицо'
+    data[:, col["Заказ клиента / Реализация.Адрес доставки"]] = np.char.add('г. Москва, ул. Тестовая, д. ', (client % 300).astype(str))
+    data[:, col["Номенклатура.Код"]] = np.char.add('Н-', product.astype(str))
+    data[:, col["Номенклатура.Артикул"]] = np.char.add('ART', product.astype(str))
+    data[:, col["Номенклатура.Наименование"]] = np.char.add('Товар ', product.astype(str))
+    data[:, col["Номенклатура.Вид номенклатуры"]] = 'Товар'
+    data[:, col["Ед. изм."]] = 'шт'
+    data[:, col["Клиент.Основной менеджер"]] = np.char.add('Менеджер ', (client % 25).astype(str))
+    quantity = rng.integers(1, 100, rows)
+    revenue = np.round(quantity * rng.uniform(10, 1000, rows), 2)
+    data[:, col["Количество"]] = quantity
+    data[:, col["Выручка"]] = revenue
+    data[:, col["Выручка с НДС"]] = np.round(revenue * 1.2, 2)
+    data[:, col["Скидка"]] = 0
+
+    # строки-заголовки дат равномерно между строками продаж
+    dates = pd.date_range('2024-01-01', periods=days).strftime('%d.%m.%Y')
+    starts = np.linspace(0, rows, days, endpoint=False).astype(int)
+    headers = np.full((days, width), None, dtype=object)
+    headers[:, 0] = dates
+    body = np.insert(data, starts, headers, axis=0)
+
+    preamble = np.full((2, width), None, dtype=object)
+    preamble[0, 0] = 'Параметры: Период: 2024 г.'
+    preamble[1, :] = SALES_REPORT_COLS
+    sheet = np.concatenate([preamble, body])
+    return pd.DataFrame(sheet, columns=['Продажи СТН'] + [f'Unnamed: {i}' for i in range(1, width)])
+
+
+CATALOG_WORDS = [
+    'кабель', 'провод', 'ВВГнг', 'АВВГ', 'ПуГВ', 'NYM', 'КГ', 'медный', 'алюминиевый',
+    'гибкий', 'силовой', 'LS', 'FRLS', 'HF', 'чёрный', 'белый', 'красный', 'синий',
+    '1x1.5', '2x2.5', '3x1.5', '3x2.5', '4x4', '5x6', '5x10', 'ГОСТ', 'ТУ', 'бухта',
+]
+
+
+def synthetic_catalog(size, queries, seed=0):
+    """Справочник товаров {наименование: подкатегория} и искомые наименования
+    с перестановкой слов, пропусками и опечатками"""
+    rng = np.random.default_rng(seed)
+    names = {}
+    while len(names) < size:
+        words = rng.choice(CATALOG_WORDS, rng.integers(3, 7), replace=False)
+        names[' '.join(words) + f' арт.{len(names)}'] = f'Подкатегория {len(names) % 40}'
+    keys = list(names)
+    search = []
+    for i in rng.integers(0, size, queries):
+        words = keys[i].split()
+        rng.shuffle(words)
+        if len(words) > 3 and rng.random() < 0.5:
+            words.pop(int(rng.integers(0, len(words))))
+        word = int(rng.integers(0, len(words)))
+        if len(words[word]) > 3:
+            words[word] = words[word][:-1]
+        search.append(' '.join(words))
+    return search, names
+
+
+def synthetic_sales_rows(rows, clients=5000, products=20000, years=(2022, 2025), seed=0):
+    """Строки таблицы sales в виде, как их пишет загрузчик продаж"""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'year': rng.integers(years[0], years[1] + 1, rows),
+        'month': rng.integers(1, 13, rows),
+        'type': 'Факт',
+        'client_code': np.char.add('К-', rng.integers(0, clients, rows).astype(str)),
+        'manager': np.char.add('Менеджер ', rng.integers(0, 25, rows).astype(str)),
+        'product_code': np.char.add('Н-', rng.integers(0, products, rows).astype(str)),
+        'product_name': np.char.add('Товар ', rng.integers(0, products, rows).astype(str)),
+        'revenue': np.round(rng.uniform(10, 100000, rows), 2),
+    }).astype({'client_code': object, 'manager': object, 'product_code': object, 'product_name': object})
+
+
+# ------------------ Эталонные реализации ------------------
+def prepare_df_loop(df: pd.DataFrame):
+    """prepare_df до векторизации (построчный проход)"""
+    row = list(df.iloc[:, 0]).index('Клиент.Код')
+    df.columns = df.iloc[row, :]
+    df = df.iloc[row+1:, :]
+    df.reset_index(inplace=True, drop=True)
+    df.fillna(0, inplace=True)
+
+    ind = list(df[df["Клиент.Наименование"] == 0].index)
+    df["Дата"] = 0
+    date_ind = list(df.columns).index("Дата")
+    ind = [0] + ind
+    k = 1
+    for i in range(len(df)):
+        try:
+            if i < ind[k]:
+                df.iloc[i, date_ind] = df.iloc[ind[k-1], 0]
+            else:
+                df.iloc[i, date_ind] = df.iloc[ind[k], 0]
+                k += 1
+        except BaseException:
+            df.iloc[i, date_ind] = df.iloc[ind[k-1], 0]
+    df.drop(df[(df["Дата"] == 0)].index, inplace=True)
+    df.drop(df[(df["Клиент.Наименование"] == 0)].index, inplace=True)
+    df.reset_index(inplace=True, drop=True)
+    df["Год"] = df["Дата"].apply(lambda x: int(x.split('.')[2]))
+    df["Месяц"] = df["Дата"].apply(lambda x: int(x.split('.')[1]))
+    df["Признак"] = "Факт"
+    return df
+
+
+def analogue_value_cross(search: list, dict_val: dict) -> dict:
+    """analogue_value до индекса (перекрёстное соединение всех пар)"""
+    from fuzzywuzzy import fuzz
+
+    df_search = pd.DataFrame(search, columns=['search'])
+    df_dict = pd.DataFrame.from_dict(dict_val, orient='index').reset_index()
+    df_dict.columns = ['analogue', 'value']
+    cross = pd.merge(df_search, df_dict, how="cross")
+    cross["ratio"] = 0
+    for i in range(len(cross)):
+        cross.iloc[i, -1] = fuzz.token_sort_ratio(cross.iloc[i, 0], cross.iloc[i, 1])
+    df_search["value"] = 0
+    for i in range(len(df_search)):
+        filtered_data = cross[cross["search"] == df_search.iloc[i, 0]]["ratio"]
+        if not filtered_data.empty:
+            value = cross.iloc[filtered_data.idxmax(), 2]
+            df_search.iloc[i, -1] = value
+        else:
+            df_search.iloc[i, -1] = None
+    return df_search.set_index('search')["value"].to_dict()
+
+
+def new_sales_pivot(df: pd.DataFrame):
+    """new_sales до замены на groupby (pivot_table по строковым ключам)"""
+    monthes = list(df["Месяц"].unique())
+    years = list(df["Год"].unique())
+    df = df[SALES_COLS]
+    df = pd.pivot_table(
+        data=df,
+        index=SALES_COLS[:-4],
+        values=SALES_COLS[-4:],
+        aggfunc='sum'
+    )
+    df.reset_index(inplace=True)
+    df = df[SALES_COLS]
+    df["Комментарий"] = '0'
+    return df, years, monthes
+
+
+# ------------------ Замеры ------------------
+@benchmark('prepare_df', 500000)
+def bench_prepare_df(rows):
+    from updater.process_report import prepare_df
+
+    raw = synthetic_sales_report(rows)
+    new, new_seconds = timed(prepare_df, raw.copy())
+    old, old_seconds = timed(prepare_df_loop, raw.copy())
+    pd.testing.assert_frame_equal(new, old, check_dtype=False)
+    report(f"prepare_df, {rows} строк", new_seconds, old_seconds)
+
+
+@benchmark('analogue_value', 1000)
+def bench_analogue_value(size):
+    from updater.matching import Matcher, normalize, score
+    from updater.process_report import analogue_value
+
+    search, names = synthetic_catalog(size, max(1, size // 10))
+    new, new_seconds = timed(analogue_value, search, names)
+    _, old_seconds = timed(analogue_value_cross, search, names)
+    report(f"analogue_value, {len(search)} x {size}", new_seconds, old_seconds)
+
+    # полнота индекса: совпадает ли лучший кандидат с перебором всего справочника
+    matcher = Matcher(names)
+    keys = [normalize(name) for name in names]
+    values = list(names.values())
+    agree = 0
+    for query in dict.fromkeys(search):
+        scores = score(normalize(query), keys)
+        top = max(range(len(keys)), key=scores.__getitem__)
+        exhaustive = values[top] if scores[top] >= matcher.threshold else None
+        agree += new[query] == exhaustive
+    logging.info(f"Совпадение с полным перебором: {agree} из {len(new)}")
+
+
+@benchmark('new_sales', 500000)
+def bench_new_sales(rows):
+    from updater.process_report import new_sales, prepare_df
+
+    # в месячной выгрузке одни и те же клиенты и товары повторяются
+    df = prepare_df(synthetic_sales_report(rows, clients=300, products=3000))
+    # прогрев: первый вызов тратит время и память на разовую инициализацию pandas
+    new_sales(df), new_sales_pivot(df)
+    new_peak, old_peak = traced_peak(new_sales, df), traced_peak(new_sales_pivot, df)
+    (new, _, _), new_seconds = timed(new_sales, df)
+    (old, _, _), old_seconds = timed(new_sales_pivot, df)
+    # pivot_table сортирует группы, groupby(sort=False) — нет
+    keys = SALES_COLS[:-4]
+    pd.testing.assert_frame_equal(
+        new.sort_values(keys, ignore_index=True), old.sort_values(keys, ignore_index=True),
+        check_dtype=False, check_names=False
+    )
+    report(f"new_sales, {rows} строк", new_seconds, old_seconds)
+    logging.info(f"📈 new_sales, пик памяти: было {old_peak / 2**20:.0f} МБ, стало {new_peak / 2**20:.0f} МБ")
+
+
+@benchmark('bulk_insert', 1000000)
+def bench_bulk_insert(rows):
+    from updater import db
+
+    df = synthetic_sales_rows(rows)
+
+    def load(path, write):
+        conn = db.connect(path)
+        try:
+            with db.transaction(conn):
+                write(conn)
+            return db.query_one(
+                "SELECT COUNT(*), ROUND(SUM(revenue), 2), COUNT(DISTINCT client_code) FROM sales", conn=conn
+            )
+        finally:
+            conn.close()
+
+    with tempfile.TemporaryDirectory(prefix='bench_') as tmp:
+        old, old_seconds = timed(load, os.path.join(tmp, 'to_sql.db'),
+                                 lambda conn: df.to_sql('sales', conn, if_exists='append', index=False))
+        new, new_seconds = timed(load, os.path.join(tmp, 'insert_df.db'),
+                                 lambda conn: db.insert_df(conn, 'sales', df))
+    assert new == old and new[0] == rows
+    report(f"insert_df против to_sql, {rows} строк", new_seconds, old_seconds)
+
+
+# Запросы страницы «Динамика продаж» к сырым продажам (до сводок)
+ANALYTICS_QUERIES = {
+    'выручка по месяцам': ("""
+        SELECT year, month, type, SUM(revenue) AS revenue FROM sales
+        WHERE type IN ('Факт', 'Bdg') GROUP BY year, month, type
+    """, ()),
+    'итоги менеджеров по годам': ("""
+        SELECT manager, year,
+               SUM(CASE WHEN type = 'Bdg' THEN revenue ELSE 0 END) AS plan,
+               SUM(CASE WHEN type = 'Факт' THEN revenue ELSE 0 END) AS fact
+        FROM sales GROUP BY manager, year
+    """, ()),
+    'клиенты менеджера за год': ("""
+        SELECT client_code, SUM(CASE WHEN type = 'Факт' THEN revenue ELSE 0 END) AS fact
+        FROM sales WHERE manager = ? AND year = ?
+        GROUP BY client_code HAVING fact > 0
+    """, ('Менеджер 3', '2024')),
+}
+
+
+@benchmark('analytics', 2000000)
+def bench_analytics(rows):
+    import duckdb
+    from updater import analytics, db
+
+    df = synthetic_sales_rows(rows, years=(2018, 2025))
+    df.loc[df.index % 4 == 0, 'type'] = 'Bdg'
+    with tempfile.TemporaryDirectory(prefix='bench_') as tmp:
+        conn = db.connect(os.path.join(tmp, 'bench.db'))
+        db.insert_df(conn, 'sales', df)
+        parquet_dir = os.path.join(tmp, 'parquet')
+        files, seconds = timed(analytics.export_table, 'sales', conn, parquet_dir)
+        logging.info(f"Выгрузка в Parquet: {files} разделов за {seconds:.2f} с")
+
+        duck = duckdb.connect()
+        for name, (sql, params) in ANALYTICS_QUERIES.items():
+            old, old_seconds = timed(db.query_df, sql, params, conn)
+            new, new_seconds = timed(analytics.query_df, sql, params, conn, duck, parquet_dir)
+            keys = [column for column in old.columns if column not in ('revenue', 'plan', 'fact')]
+            pd.testing.assert_frame_equal(
+                new.sort_values(keys, ignore_index=True), old.sort_values(keys, ignore_index=True),
+                check_dtype=False, check_exact=False
+            )
+            report(f"{name}, DuckDB против SQLite, {rows} строк", new_seconds, old_seconds)
+        duck.close()
+        conn.close()
+
+
+def main(argv):
+    if not argv or argv[0] not in BENCHMARKS:
+        print(__doc__)
+        print("Замеры:", ", ".join(BENCHMARKS))
+        return 1
+    fn, rows = BENCHMARKS[argv[0]]
+    fn(int(argv[1]) if len(argv) > 1 else rows)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
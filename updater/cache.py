@@ -0,0 +1,159 @@
+import os
+import logging
+import importlib.util
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from updater.excel import BATCH_ROWS
+
+load_dotenv()
+DB_PATH = os.getenv("DB_PATH", "db.db")
+
+# Кэш разобранных отчётов: нормализованный DataFrame в Parquet по ключу
+# (вид отчёта, версия парсера, sha256 вложения). Нужен pyarrow; без него
+# кэш отключён. REPORT_CACHE_MAX_MB=0 тоже отключает кэш. По умолчанию
+# лежит рядом с базой, а не в текущем каталоге: cron, Airflow и дашборд
+# запускаются из разных каталогов.
+CACHE_DIR = os.getenv("REPORT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "cache", "reports"))
+CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_MB", 512)) * 1024 * 1024
+
+
+def cache_enabled():
+    return CACHE_MAX_BYTES > 0 and importlib.util.find_spec('pyarrow') is not None
+
+
+def _path(kind, version, sha256):
+    return os.path.join(CACHE_DIR, f"{kind}-v{version}-{sha256}.parquet")
+
+
+def _to_arrow(df):
+    # в object-колонках 1С встречаются вперемешку числа и строки (артикулы),
+    # Arrow так не умеет — храним их как строки
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].astype('string')
+    return df
+
+
+def _from_arrow(df):
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.StringDtype):
+            df[col] = df[col].astype(object).where(df[col].notna(), None)
+    return df
+
+
+# ------------------ Чтение ------------------
+def iter_cached(kind, version, sha256, batch_rows=BATCH_ROWS):
+    """Пачки DataFrame из кэша или None, если записи нет"""
+    if not sha256 or not cache_enabled():
+        return None
+    path = _path(kind, version, sha256)
+    if not os.path.exists(path):
+        return None
+    os.utime(path)  # время доступа для вытеснения LRU
+    logging.info(f"⚡ {kind}: разобранный отчёт взят из кэша")
+    return _iter_parquet(path, batch_rows)
+
+
+def _iter_parquet(path, batch_rows):
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows):
+        yield _from_arrow(batch.to_pandas())
+
+
+def read_cached(kind, version, sha256):
+    batches = iter_cached(kind, version, sha256)
+    if batches is None:
+        return None
+    batches = list(batches)
+    return pd.concat(batches, ignore_index=True) if batches else pd.DataFrame()
+
+
+# ------------------ Запись ------------------
+class CacheWriter:
+    """Пишет разобранный отчёт в кэш по пачкам.
+
+    Файл появляется в кэше только после close(ok=True); ошибки записи в
+    кэш не прерывают загрузку, а только отключают кэширование этого отчёта.
+    """
+
+    def __init__(self, kind, version, sha256):
+        self.kind = kind
+        self.version = version
+        self.enabled = bool(sha256) and cache_enabled()
+        self._path = _path(kind, version, sha256) if self.enabled else None
+        self._tmp = f"{self._path}.tmp" if self.enabled else None
+        self._writer = None
+        self._schema = None
+
+    def write(self, df):
+        if not self.enabled:
+            return
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(_to_arrow(df), schema=self._schema, preserve_index=False)
+            if self._writer is None:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                self._schema = table.schema
+                self._writer = pq.ParquetWriter(self._tmp, self._schema)
+            self._writer.write_table(table)
+        except Exception as e:
+            logging.warning(f"Не удалось записать отчёт {self.kind} в кэш: {e}")
+            self._abort()
+
+    def _abort(self):
+        self.enabled = False
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._tmp and os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+    def close(self, ok=True):
+        if not self.enabled or self._writer is None:
+            return
+        if not ok:
+            self._abort()
+            return
+        self._writer.close()
+        self._writer = None
+        os.replace(self._tmp, self._path)
+        drop_stale_versions(self.kind, self.version)
+        evict()
+
+
+def store_cached(kind, version, sha256, df):
+    writer = CacheWriter(kind, version, sha256)
+    writer.write(df)
+    writer.close()
+
+
+# ------------------ Инвалидация и вытеснение ------------------
+def drop_stale_versions(kind, version):
+    """Удаляет записи этого вида отчёта, сделанные другой версией парсера"""
+    current = f"{kind}-v{version}-"
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith(f"{kind}-v") and not name.startswith(current):
+            os.remove(os.path.join(CACHE_DIR, name))
+
+
+def evict(max_bytes=CACHE_MAX_BYTES):
+    """Удаляет давно не использованные записи, пока кэш больше max_bytes"""
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if not name.endswith('.parquet'):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
@@ -0,0 +1,288 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Any, Iterable, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DB_PATH = os.getenv("DB_PATH", "db.db")
+# Отображение файла базы в память и размер кэша страниц на соединение
+MMAP_SIZE = int(os.getenv("SQLITE_MMAP_MB", 256)) * 1024 * 1024
+CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_MB", 64)) * 1024
+# Сколько ждать снятия блокировки записи другим процессом
+BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 30000))
+
+_local = threading.local()
+
+
+class Connection(sqlite3.Connection):
+    """Соединение с блокировкой: запросы через функции модуля можно делать
+    из разных потоков, если соединение открыто с shared=True"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.RLock()
+
+
+def connect(db_path: str = DB_PATH, shared: bool = False) -> Connection:
+    """Новое соединение с настройками для одновременного чтения и загрузки.
+
+    WAL: читатели не блокируются записью и не блокируют её;
+    synchronous=NORMAL в режиме WAL не теряет целостность при сбое.
+    """
+    conn = sqlite3.connect(
+        db_path,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        factory=Connection,
+        check_same_thread=not shared
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    _migrate_once(conn, db_path)
+    return conn
+
+
+_migrated = set()
+_migrate_lock = threading.Lock()
+
+
+def _migrate_once(conn, db_path):
+    """Схема базы доводится до текущей версии при первом соединении в процессе"""
+    from updater.migrations import migrate
+
+    key = os.path.abspath(db_path)
+    with _migrate_lock:
+        if key not in _migrated:
+            migrate(conn)
+            _migrated.add(key)
+
+
+def get_connection(db_path: str = DB_PATH) -> Connection:
+    """Соединение текущего потока: открывается один раз и дальше переиспользуется"""
+    if getattr(_local, 'pid', None) != os.getpid():
+        # после fork соединения родителя использовать нельзя
+        _local.pid = os.getpid()
+        _local.connections = {}
+    key = os.path.abspath(db_path)
+    conn = _local.connections.get(key)
+    if conn is None:
+        conn = _local.connections[key] = connect(db_path)
+    return conn
+
+
+def close_connections():
+    """Закрывает соединения текущего потока"""
+    for conn in getattr(_local, 'connections', {}).values():
+        conn.close()
+    _local.connections = {}
+
+
+def _lock(conn):
+    return getattr(conn, 'lock', None) or nullcontext()
+
+
+# ------------------ Запросы ------------------
+def query_df(sql: str, params: Sequence = (), conn: Optional[sqlite3.Connection] = None) -> pd.DataFrame:
+    conn = conn or get_connection()
+    with _lock(conn):
+        return pd.read_sql_query(sql, conn, params=params)
+
+
+def query_all(sql: str, params: Sequence = (), conn: Optional[sqlite3.Connection] = None) -> list:
+    conn = conn or get_connection()
+    with _lock(conn):
+        return conn.execute(sql, params).fetchall()
+
+
+def query_one(sql: str, params: Sequence = (), conn: Optional[sqlite3.Connection] = None) -> Optional[tuple]:
+    conn = conn or get_connection()
+    with _lock(conn):
+        return conn.execute(sql, params).fetchone()
+
+
+def query_value(sql: str, params: Sequence = (), default: Any = None,
+                conn: Optional[sqlite3.Connection] = None) -> Any:
+    """Первая колонка первой строки или default"""
+    row = query_one(sql, params, conn)
+    return default if row is None or row[0] is None else row[0]
+
+
+# ------------------ Запись ------------------
+@contextmanager
+def transaction(conn: Optional[sqlite3.Connection] = None, immediate: bool = False):
+    """Транзакция: commit при выходе, rollback при исключении.
+
+    BEGIN явный, чтобы в транзакцию попадали и CREATE/DROP (sqlite3 сам
+    открывает её только перед INSERT/UPDATE/DELETE). Вложенный вызов
+    работает внутри внешней транзакции.
+
+    immediate=True — BEGIN IMMEDIATE: блокировка записи берётся сразу, с
+    ожиданием busy_timeout. Нужно, если транзакция сначала читает, а потом
+    пишет: в режиме WAL отложенная транзакция, чей снимок устарел из-за
+    чужой записи, получает «database is locked» сразу, без ожидания.
+    """
+    conn = conn or get_connection()
+    with _lock(conn):
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+def execute(sql: str, params: Sequence = (), conn: Optional[sqlite3.Connection] = None) -> int:
+    """Выполняет запрос в отдельной транзакции, возвращает число изменённых строк"""
+    with transaction(conn) as c:
+        return c.execute(sql, params).rowcount
+
+
+def executemany(sql: str, rows: Iterable[Sequence], conn: Optional[sqlite3.Connection] = None) -> int:
+    with transaction(conn) as c:
+        return c.executemany(sql, rows).rowcount
+
+
+def _column_values(column: pd.Series) -> Iterable:
+    """Значения колонки в виде, который принимает sqlite3: python-числа,
+    строки и None вместо NaN/NaT; даты — строками, как их пишет to_sql"""
+    if pd.api.types.is_datetime64_any_dtype(column):
+        codes, uniques = pd.factorize(column)
+        text = np.array([value.isoformat(' ') for value in uniques] + [None], dtype=object)
+        return text[codes]
+    values = column.to_numpy(dtype=object)
+    if column.dtype.kind not in 'iub':
+        values[pd.isna(values)] = None
+    return values
+
+
+@contextmanager
+def _deferred_indexes(conn: sqlite3.Connection, table: str):
+    """Индексы таблицы удаляются на время вставки и строятся заново после неё"""
+    indexes = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (table,)
+    ).fetchall()
+    for name, _ in indexes:
+        conn.execute(f'DROP INDEX "{name}"')
+    yield
+    for _, sql in indexes:
+        conn.execute(sql)
+
+
+def insert_df(conn: sqlite3.Connection, table: str, df: pd.DataFrame, immediate: bool = True) -> int:
+    """Вставляет кадр одним executemany по подготовленному INSERT.
+
+    Колонки переводятся в python-значения один раз, строки собираются
+    zip'ом без промежуточного списка. Внутри transaction() вызывающего
+    вставка атомарна вместе с удалением раздела.
+
+    Если строк вставляется не меньше, чем уже есть в таблице (первая
+    загрузка, дозагрузка архива), индексы строятся заново после вставки:
+    сортировка один раз дешевле поддержки индексов на каждой строке.
+
+    immediate=False — для TEMP-таблиц (staging()): им блокировка записи
+    основной базы не нужна.
+    """
+    if df.empty:
+        return 0
+    columns = ', '.join(f'"{column}"' for column in df.columns)
+    marks = ', '.join('?' * len(df.columns))
+    rows = zip(*(_column_values(df[column]) for column in df.columns))
+    # MAX(rowid) берётся из конца b-дерева, без прохода по таблице
+    with transaction(conn, immediate=immediate):
+        existing = conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+        with _deferred_indexes(conn, table) if len(df) >= existing else nullcontext():
+            conn.executemany(f"INSERT INTO {table} ({columns}) VALUES ({marks})", rows)
+    return len(df)
+
+
+@contextmanager
+def backfill(conn: Optional[sqlite3.Connection] = None):
+    """Режим дозагрузки архива: synchronous=OFF на время блока.
+
+    Запись не ждёт сброса на диск; при сбое ОС последние транзакции могут
+    потеряться (файл базы останется целым), поэтому только для данных,
+    которые можно загрузить повторно.
+    """
+    conn = conn or get_connection()
+    with _lock(conn):
+        conn.execute("PRAGMA synchronous=OFF")
+        try:
+            yield conn
+        finally:
+            conn.execute("PRAGMA synchronous=NORMAL")
+
+
+def swap_tables(conn: sqlite3.Connection, table: str, staging: str, previous: str):
+    """Подставляет staging на место table переименованием в одной короткой
+    транзакции; прежняя таблица сохраняется как previous (для отката).
+
+    Читатели в режиме WAL не блокируются и видят либо прежнюю таблицу,
+    либо новую целиком.
+    """
+    with transaction(conn, immediate=True):
+        conn.execute(f"DROP TABLE IF EXISTS {previous}")
+        conn.execute(f"ALTER TABLE {table} RENAME TO {previous}")
+        conn.execute(f"ALTER TABLE {staging} RENAME TO {table}")
+
+
+@contextmanager
+def staging(conn: sqlite3.Connection, table: str, columns: Optional[Sequence[str]] = None):
+    """Временная (TEMP) таблица с колонками table для разбора отчёта до загрузки.
+
+    Запись в TEMP-таблицу не берёт блокировку записи основной базы, поэтому
+    потоковый разбор книги не задерживает другие загрузчики и слушатель.
+    Строки переносятся в table через insert_staged() в короткой транзакции.
+    Возвращает имя временной таблицы; при выходе она удаляется.
+    """
+    name = f"temp.staging_{table}"
+    select = ', '.join(f'"{column}"' for column in columns) if columns else '*'
+    conn.execute(f"DROP TABLE IF EXISTS {name}")
+    conn.execute(f"CREATE TABLE {name} AS SELECT {select} FROM main.{table} WHERE 0")
+    try:
+        yield name
+    finally:
+        conn.execute(f"DROP TABLE IF EXISTS {name}")
+
+
+def insert_staged(conn: sqlite3.Connection, table: str, staged: str) -> int:
+    """Переносит строки временной таблицы staging() в table одним INSERT ... SELECT.
+
+    Вызывается внутри transaction(immediate=True) вместе с удалением
+    раздела. Индексы, как в insert_df, строятся заново, если строк
+    переносится не меньше, чем уже есть в таблице.
+    """
+    with _lock(conn):
+        schema, name = staged.split('.')
+        columns = ', '.join(f'"{row[1]}"' for row in conn.execute(f"PRAGMA {schema}.table_info({name})"))
+        count = conn.execute(f"SELECT COUNT(*) FROM {staged}").fetchone()[0]
+        existing = conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+        with _deferred_indexes(conn, table) if count and count >= existing else nullcontext():
+            conn.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {staged}")
+    return count
+
+
+def delete_partitions(conn: sqlite3.Connection, table: str, columns: Sequence[str],
+                      partitions: Iterable[Sequence], where: Optional[str] = None) -> int:
+    """Удаляет разделы таблицы (значения columns) перед их повторной загрузкой.
+
+    Вызывается внутри transaction() вместе со вставкой, чтобы читатели видели
+    либо старый, либо новый раздел целиком. where — дополнительное условие
+    (например, защита строк, исправленных вручную).
+    """
+    condition = ' AND '.join(f"{column} = ?" for column in columns)
+    if where:
+        condition += f" AND ({where})"
+    return conn.executemany(f"DELETE FROM {table} WHERE {condition}", partitions).rowcount
@@ -0,0 +1,180 @@
+import io
+import os
+import logging
+import importlib.util
+from collections import namedtuple
+from datetime import date, datetime, time
+
+import pandas as pd
+
+# Сколько строк листа собирать в один DataFrame при потоковом чтении
+BATCH_ROWS = 50000
+
+# Как читать лист отчёта:
+#   header  — номер строки заголовка (0-based) или список строк для многоуровневого
+#             заголовка, None — без заголовка (как в pd.read_excel)
+#   columns — имена первых len(columns) столбцов для позиционного потокового чтения;
+#             если заданы, header не используется
+#   min_row — первая строка данных (1-based) при позиционном чтении
+Layout = namedtuple('Layout', ['header', 'columns', 'min_row'], defaults=(0, None, 1))
+
+XLSX_MAGIC = b'PK\x03\x04'
+XLS_MAGIC = b'\xd0\xcf\x11\xe0'
+
+
+# ------------------ Движки ------------------
+def _cell(value):
+    """Значение ячейки как у pd.read_excel: целые числа — int (Excel хранит
+    их как float, и артикул 12345 иначе записался бы в базу как '12345.0'),
+    даты — datetime"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return datetime.combine(value, time())
+    return value
+
+
+def _rows_calamine(src, min_row):
+    from python_calamine import CalamineWorkbook
+
+    wb = CalamineWorkbook.from_filelike(src) if hasattr(src, 'read') else CalamineWorkbook.from_path(src)
+    sheet = wb.get_sheet_by_index(0)
+    for i, row in enumerate(sheet.iter_rows(), start=1):
+        if i >= min_row:
+            # пустые ячейки calamine отдаёт как ''
+            yield tuple(None if v == '' else _cell(v) for v in row)
+
+
+def _rows_openpyxl(src, min_row):
+    from openpyxl import load_workbook
+
+    wb = load_workbook(src, read_only=True, data_only=True)
+    try:
+        yield from wb.active.iter_rows(min_row=min_row, values_only=True)
+    finally:
+        wb.close()
+
+
+def _rows_xlrd(src, min_row):
+    import xlrd
+
+    if hasattr(src, 'read'):
+        book = xlrd.open_workbook(file_contents=src.read(), on_demand=True)
+    else:
+        book = xlrd.open_workbook(src, on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        for i in range(min_row - 1, sheet.nrows):
+            row = []
+            for cell in sheet.row(i):
+                if cell.ctype == xlrd.XL_CELL_EMPTY or cell.value == '':
+                    row.append(None)
+                elif cell.ctype == xlrd.XL_CELL_DATE:
+                    row.append(xlrd.xldate_as_datetime(cell.value, book.datemode))
+                elif cell.ctype == xlrd.XL_CELL_BOOLEAN:
+                    row.append(bool(cell.value))
+                elif cell.ctype == xlrd.XL_CELL_ERROR:
+                    row.append(None)
+                else:
+                    row.append(_cell(cell.value))
+            yield tuple(row)
+    finally:
+        book.release_resources()
+
+
+# Движки в порядке предпочтения (от быстрого к медленному):
+# имя -> (модуль, форматы, построчное чтение, engine для pd.read_excel)
+ENGINES = {
+    'calamine': ('python_calamine', ('xlsx', 'xls'), _rows_calamine, 'calamine'),
+    'openpyxl': ('openpyxl', ('xlsx',), _rows_openpyxl, 'openpyxl'),
+    'xlrd': ('xlrd', ('xls',), _rows_xlrd, 'xlrd'),
+}
+
+
+def _pandas_has_calamine():
+    return tuple(int(x) for x in pd.__version__.split('.')[:2]) >= (2, 2)
+
+
+def available_engines(fmt, pandas_read=False):
+    """Установленные движки, умеющие читать формат, в порядке предпочтения"""
+    engines = []
+    for name, (module, formats, _, _) in ENGINES.items():
+        if fmt not in formats or importlib.util.find_spec(module) is None:
+            continue
+        if pandas_read and name == 'calamine' and not _pandas_has_calamine():
+            continue
+        engines.append(name)
+    return engines
+
+
+def detect_format(src):
+    """'xls' или 'xlsx' по сигнатуре файла (расширение вложений не всегда верное)"""
+    if isinstance(src, (bytes, bytearray)):
+        head = bytes(src[:4])
+    else:
+        with open(src, 'rb') as f:
+            head = f.read(4)
+    if head == XLS_MAGIC:
+        return 'xls'
+    if head == XLSX_MAGIC:
+        return 'xlsx'
+    ext = os.path.splitext(src)[1].lower().lstrip('.') if isinstance(src, str) else ''
+    return 'xls' if ext == 'xls' else 'xlsx'
+
+
+def choose_engine(src, pandas_read=False):
+    fmt = detect_format(src)
+    engines = available_engines(fmt, pandas_read)
+    if not engines:
+        raise RuntimeError(f"Нет установленного движка для чтения {fmt}")
+    return engines[0]
+
+
+def _open(src):
+    return io.BytesIO(src) if isinstance(src, (bytes, bytearray)) else src
+
+
+# ------------------ Чтение отчётов ------------------
+def iter_report(src, layout, batch_rows=BATCH_ROWS, engine=None):
+    """Потоковое позиционное чтение первого листа пачками по batch_rows строк.
+
+    src — путь к файлу или байты вложения. Берутся первые len(layout.columns)
+    столбцов начиная со строки layout.min_row; память ограничена размером
+    пачки, а не размером книги.
+    """
+    engine = engine or choose_engine(src)
+    logging.info(f"📄 Чтение отчёта движком {engine}")
+    rows = ENGINES[engine][2](_open(src), layout.min_row)
+    columns = list(layout.columns)
+    width = len(columns)
+    batch = []
+    for row in rows:
+        row = tuple(row[:width])
+        if len(row) < width:
+            row += (None,) * (width - len(row))
+        batch.append(row)
+        if len(batch) >= batch_rows:
+            yield pd.DataFrame.from_records(batch, columns=columns)
+            batch = []
+    if batch:
+        yield pd.DataFrame.from_records(batch, columns=columns)
+
+
+def read_report(src, layout=Layout(), engine=None):
+    """Читает первый лист отчёта в DataFrame самым быстрым доступным движком.
+
+    src — путь к файлу или байты вложения. Использованный движок
+    сохраняется в df.attrs['engine'].
+    """
+    started = datetime.now()
+    if layout.columns is not None:
+        engine = engine or choose_engine(src)
+        batches = list(iter_report(src, layout, engine=engine))
+        df = pd.concat(batches, ignore_index=True) if batches else pd.DataFrame(columns=layout.columns)
+    else:
+        engine = engine or choose_engine(src, pandas_read=True)
+        df = pd.read_excel(_open(src), header=layout.header, engine=ENGINES[engine][3])
+    seconds = (datetime.now() - started).total_seconds()
+    logging.info(f"📄 Отчёт прочитан движком {engine}: {len(df)} строк за {seconds:.2f} с")
+    df.attrs['engine'] = engine
+    return df
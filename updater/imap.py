@@ -0,0 +1,287 @@
+import os
+import re
+import base64
+import imaplib
+import quopri
+from email.header import decode_header
+from email.parser import BytesHeaderParser
+from urllib.parse import unquote
+
+# Сколько UID запрашивать одной командой FETCH
+FETCH_BATCH = 200
+# Размер куска при потоковой загрузке вложения (частичный FETCH <offset.length>)
+STREAM_CHUNK = 1024 * 1024
+
+HEADER_ITEM = 'BODY[HEADER.FIELDS (SUBJECT DATE)]'
+_LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+
+
+# ------------------ Почтовые утилиты ------------------
+def get_email_credentials():
+    user = os.getenv("EMAIL_USER")
+    pwd  = os.getenv("EMAIL_PASSWORD")
+    srv  = os.getenv("EMAIL_SERVER", "imap.gmail.com")
+    missing = [v for v in ("EMAIL_USER","EMAIL_PASSWORD","EMAIL_SERVER") if not os.getenv(v)]
+    if missing:
+        raise RuntimeError(f"Не найдены переменные окружения: {', '.join(missing)}.")
+    return user, pwd, srv
+
+def connect_to_email():
+    user, pwd, srv = get_email_credentials()
+    mail = imaplib.IMAP4_SSL(srv)
+    mail.login(user, pwd)
+    return mail
+
+def decode_mime_words(s):
+    decoded_fragments = decode_header(s or '')
+    return ''.join([
+        fragment.decode(encoding or 'utf-8') if isinstance(fragment, bytes) else fragment
+        for fragment, encoding in decoded_fragments
+    ])
+
+
+# ------------------ Разбор ответа FETCH ------------------
+class _Literal:
+    """Маркер IMAP-литерала в потоке токенов ответа"""
+    def __init__(self, data):
+        self.data = data
+
+
+def _tokenize(chunks):
+    for chunk in chunks:
+        if isinstance(chunk, _Literal):
+            yield chunk
+            continue
+        i, n = 0, len(chunk)
+        while i < n:
+            c = chunk[i:i + 1]
+            if c in b' \r\n':
+                i += 1
+            elif c in b'()':
+                yield c.decode()
+                i += 1
+            elif c == b'"':
+                j, buf = i + 1, bytearray()
+                while j < n and chunk[j:j + 1] != b'"':
+                    if chunk[j:j + 1] == b'\\':
+                        j += 1
+                    buf += chunk[j:j + 1]
+                    j += 1
+                yield bytes(buf)
+                i = j + 1
+            else:
+                # Атом; содержимое [...] (например BODY[HEADER.FIELDS (A B)]) входит в атом целиком
+                j, depth = i, 0
+                while j < n:
+                    ch = chunk[j:j + 1]
+                    if ch == b'[':
+                        depth += 1
+                    elif ch == b']':
+                        depth -= 1
+                    elif depth == 0 and ch in b' ()\r\n"':
+                        break
+                    j += 1
+                atom = chunk[i:j].decode('ascii', 'replace')
+                yield None if atom.upper() == 'NIL' else atom
+                i = j
+
+
+def _parse_list(tokens):
+    items = []
+    for tok in tokens:
+        if tok == '(':
+            items.append(_parse_list(tokens))
+        elif tok == ')':
+            return items
+        elif isinstance(tok, _Literal):
+            items.append(tok.data)
+        else:
+            items.append(tok)
+    return items
+
+
+def parse_fetch_response(data):
+    """Разбирает ответ imaplib на FETCH в список словарей {элемент: значение}"""
+    chunks = []
+    for item in data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            m = _LITERAL_RE.search(prefix)
+            chunks.append(prefix[:m.start()] if m else prefix)
+            chunks.append(_Literal(literal))
+        elif item:
+            chunks.append(item)
+
+    tokens = _tokenize(chunks)
+    messages = []
+    for tok in tokens:
+        if tok != '(':
+            continue  # порядковый номер сообщения
+        values = _parse_list(tokens)
+        messages.append({
+            str(values[i]).upper(): values[i + 1] for i in range(0, len(values) - 1, 2)
+        })
+    return messages
+
+
+# ------------------ BODYSTRUCTURE ------------------
+def _params(lst):
+    if not isinstance(lst, list):
+        return {}
+    return {
+        _text(lst[i]).lower(): _text(lst[i + 1]) for i in range(0, len(lst) - 1, 2)
+    }
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value or ''
+
+
+def _filename(params):
+    if 'filename' in params:
+        return decode_mime_words(params['filename'])
+    if 'name' in params:
+        return decode_mime_words(params['name'])
+    # RFC 2231: filename*=utf-8''..., в т.ч. разбитый на filename*0*, filename*1* ...
+    pieces = sorted(
+        (k for k in params if k.startswith('filename*')),
+        key=lambda k: int(re.sub(r'\D', '', k) or 0)
+    )
+    if pieces:
+        raw = ''.join(params[k] for k in pieces)
+        if raw.count("'") >= 2:
+            charset, _, value = raw.split("'", 2)
+            return unquote(value, encoding=charset or 'utf-8', errors='replace')
+        return unquote(raw)
+    return ''
+
+
+def walk_structure(structure, prefix=''):
+    """Листовые MIME-части: (секция, тип, подтип, параметры, кодировка, имя файла, размер)"""
+    if structure and isinstance(structure[0], list):
+        # после вложенных частей multipart идут подтип и расширения, а не части
+        n = 0
+        for part in structure:
+            if not isinstance(part, list):
+                break
+            n += 1
+            yield from walk_structure(part, f"{prefix}{n}.")
+        return
+
+    maintype, subtype = _text(structure[0]).lower(), _text(structure[1]).lower()
+    params = _params(structure[2])
+    encoding = _text(structure[5]).lower()
+    size = int(structure[6]) if str(structure[6] or '').isdigit() else 0
+    # Расширенные поля: disposition идёт после md5 (text/* имеет лишнее поле lines)
+    ext_start = 8 if maintype == 'text' else 7
+    if maintype == 'message' and subtype == 'rfc822':
+        ext_start = 10
+    disposition = {}
+    for value in structure[ext_start:ext_start + 3]:
+        if isinstance(value, list) and value and isinstance(value[0], (str, bytes)):
+            disposition = _params(value[1])
+            break
+    filename = _filename({**params, **disposition})
+    yield (prefix.rstrip('.') or '1'), maintype, subtype, params, encoding, filename, size
+
+
+def find_excel_part(parts):
+    for part in parts:
+        if part[5].lower().endswith(('.xls', '.xlsx')):
+            return part
+    return None
+
+
+def find_text_part(parts):
+    for part in parts:
+        if part[1] == 'text' and part[2] == 'plain' and not part[5]:
+            return part
+    return None
+
+
+def decode_part(data, encoding):
+    if encoding == 'base64':
+        return base64.b64decode(data)
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    return data
+
+
+class StreamDecoder:
+    """Декодирует base64 / quoted-printable по кускам произвольной длины"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self._tail = b''
+
+    def feed(self, data):
+        if self.encoding == 'base64':
+            data = self._tail + data.translate(None, b' \t\r\n')
+            n = len(data) - len(data) % 4
+        elif self.encoding == 'quoted-printable':
+            # мягкий перенос "=\r\n" может оказаться на границе куска
+            data = self._tail + data
+            n = data.rfind(b'\n') + 1
+        else:
+            return data
+        self._tail = data[n:]
+        return decode_part(data[:n], self.encoding)
+
+    def flush(self):
+        tail, self._tail = self._tail, b''
+        return decode_part(tail, self.encoding) if tail else b''
+
+
+# ------------------ Команды ------------------
+def search_uids(mail, *criteria):
+    _, data = mail.uid('SEARCH', None, *criteria)
+    return [int(u) for u in (data[0] or b'').split()]
+
+
+def fetch_headers(mail, uids):
+    """Заголовки Subject/Date и BODYSTRUCTURE пачками по FETCH_BATCH UID.
+
+    Возвращает {uid: (заголовки, bodystructure)}; тела писем не скачиваются.
+    """
+    result = {}
+    parser = BytesHeaderParser()
+    for i in range(0, len(uids), FETCH_BATCH):
+        batch = ','.join(str(u) for u in uids[i:i + FETCH_BATCH])
+        _, data = mail.uid('FETCH', batch, '(UID BODY.PEEK[HEADER.FIELDS (SUBJECT DATE)] BODYSTRUCTURE)')
+        for item in parse_fetch_response(data):
+            if 'UID' not in item:
+                continue
+            headers = parser.parsebytes(item.get(HEADER_ITEM) or b'')
+            result[int(item['UID'])] = (headers, item.get('BODYSTRUCTURE') or [])
+    return result
+
+
+def fetch_section_chunks(mail, uid, section, size=0, chunk=STREAM_CHUNK):
+    """Скачивает MIME-секцию частичными FETCH по `chunk` байт (в исходной кодировке)"""
+    offset = 0
+    while True:
+        _, data = mail.uid('FETCH', str(uid), f'(BODY.PEEK[{section}]<{offset}.{chunk}>)')
+        piece = b''
+        for item in parse_fetch_response(data):
+            for key, value in item.items():
+                if key.startswith(f'BODY[{section}]'):
+                    piece = value or b''
+        if piece:
+            yield piece
+        offset += len(piece)
+        if len(piece) < chunk or (size and offset >= size):
+            return
+
+
+def fetch_sections(mail, uid, sections):
+    """Скачивает только указанные MIME-секции письма: {секция: сырые байты}"""
+    items = ' '.join(f'BODY.PEEK[{s}]' for s in sections)
+    _, data = mail.uid('FETCH', str(uid), f'({items})')
+    result = {}
+    for item in parse_fetch_response(data):
+        for s in sections:
+            if f'BODY[{s}]' in item:
+                result[s] = item[f'BODY[{s}]'] or b''
+    return result
@@ -0,0 +1,355 @@
+import os
+import sys
+import hashlib
+import tempfile
+import logging
+from collections import namedtuple
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from dotenv import load_dotenv
+
+from updater import db
+from updater.imap import (
+    FETCH_BATCH, StreamDecoder, decode_mime_words, decode_part, find_excel_part,
+    find_text_part
+)
+from updater.sources import ImapSource, SourcePool
+
+load_dotenv()
+DB_PATH = os.getenv("DB_PATH", "db.db")
+# Где создаются временные каталоги запусков (по умолчанию системный temp)
+INGEST_TEMP_DIR = os.getenv("INGEST_TEMP_DIR")
+# Дозагрузка архива (replay) с synchronous=OFF: быстрее, но без гарантии
+# сохранности последних транзакций при сбое ОС
+REPLAY_SYNC_OFF = os.getenv("REPLAY_SYNC_OFF", "0") == "1"
+
+# Письмо с найденным Excel-вложением, которое передаётся обработчику отчёта
+MailReport = namedtuple('MailReport', ['uid', 'subject', 'date', 'filename', 'path', 'body', 'sha256'])
+
+# Зарегистрированные обработчики отчётов: имя -> параметры
+HANDLERS = {}
+
+
+def save_attachment(source, uid, part, run_dir):
+    """Потоково скачивает и декодирует вложение в файл каталога запуска.
+
+    В памяти одновременно находится не больше одного куска вложения.
+    Возвращает (путь, sha256 содержимого, размер в байтах).
+    """
+    section, encoding, filename, size = part[0], part[4], part[5], part[6]
+    path = os.path.join(run_dir, f"{uid}_{os.path.basename(filename)}")
+    sha256 = hashlib.sha256()
+    decoder = StreamDecoder(encoding)
+    written = 0
+    with open(path, 'wb') as f:
+        for chunk in source.stream(uid, section, size):
+            data = decoder.feed(chunk)
+            sha256.update(data)
+            f.write(data)
+            written += len(data)
+        data = decoder.flush()
+        sha256.update(data)
+        f.write(data)
+        written += len(data)
+    return path, sha256.hexdigest(), written
+
+def reset_peak_memory():
+    """Сбрасывает пик RSS процесса (VmHWM, только Linux).
+
+    Возвращает True, если пик сброшен и peak_memory_mb() покажет пик
+    с этого момента, а не за всё время процесса (слушатель работает сутками).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_memory_mb():
+    """Пиковый RSS процесса в МБ (None, если платформа не даёт его узнать).
+
+    На Linux — VmHWM, который сбрасывает reset_peak_memory(); иначе
+    ru_maxrss — пик за всё время процесса.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт КБ, macOS — байты
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+def log_peak_memory(since_reset=False):
+    label = "за проход" if since_reset else "за всё время процесса"
+    peak = peak_memory_mb()
+    logging.info(f"📈 Пиковый RSS {label}: {peak:.0f} МБ" if peak else "📈 Пиковый RSS: н/д")
+
+
+# ------------------ Регистрация обработчиков ------------------
+def report_handler(name, *keywords, days=14, body=False, report_date=None):
+    """Регистрирует обработчик отчёта.
+
+    Письмо передаётся обработчику, если его тема содержит одно из ключевых
+    слов и оно не старше `days` дней. Обработчик получает MailReport и
+    возвращает (дата отчёта, число загруженных строк) при успешной загрузке
+    или False. Текст письма скачивается только для обработчиков с body=True.
+    report_date — функция, получающая дату отчёта из темы письма: тогда
+    одинаковое вложение за разные даты загружается для каждой даты.
+    """
+    def decorator(func):
+        HANDLERS[name] = {
+            'keywords': tuple(k.lower() for k in keywords),
+            'days': days,
+            'body': body,
+            'report_date': report_date,
+            'func': func,
+        }
+        return func
+    return decorator
+
+def match_report(subject, names=None):
+    """Имя обработчика, к которому относится письмо с данной темой"""
+    subject = subject.lower()
+    for name, handler in HANDLERS.items():
+        if names is not None and name not in names:
+            continue
+        if any(k in subject for k in handler['keywords']):
+            return name
+    return None
+
+
+# ------------------ Водяные знаки UID ------------------
+def load_watermarks(db_path, uidvalidity):
+    """Последний обработанный UID по каждому отчёту.
+
+    Записи с другим UIDVALIDITY (ящик пересоздан, UID переиспользованы)
+    удаляются, и для этих отчётов поиск снова идёт по окну дат.
+    """
+    with db.transaction(db.get_connection(db_path), immediate=True) as conn:
+        conn.execute('DELETE FROM ingest_state WHERE uidvalidity != ?', (uidvalidity,))
+        rows = conn.execute('SELECT report_type, last_uid FROM ingest_state').fetchall()
+    return dict(rows)
+
+def save_watermarks(db_path, uidvalidity, watermarks):
+    db.executemany(
+        'INSERT OR REPLACE INTO ingest_state VALUES (?, ?, ?, ?)',
+        [(name, uidvalidity, uid, datetime.now()) for name, uid in watermarks.items()],
+        db.get_connection(db_path)
+    )
+
+# ------------------ Журнал загруженных вложений ------------------
+def is_ingested(db_path, sha256, report_type, report_date=None):
+    """Загружалось ли вложение; с report_date — именно за эту дату отчёта"""
+    sql = 'SELECT 1 FROM ingest_ledger WHERE sha256 = ? AND report_type = ?'
+    params = (sha256, report_type)
+    if report_date is not None:
+        sql += ' AND report_date = ?'
+        params += (str(report_date),)
+    row = db.query_one(sql, params, db.get_connection(db_path))
+    return row is not None
+
+def record_ingested(db_path, sha256, report_type, uid, report_date, rows):
+    db.execute(
+        'INSERT OR REPLACE INTO ingest_ledger VALUES (?, ?, ?, ?, ?, ?)',
+        (sha256, report_type, uid, str(report_date), rows, datetime.now()),
+        db.get_connection(db_path)
+    )
+
+
+# ------------------ Разбор почтового ящика ------------------
+def _message_date(msg_headers, default):
+    try:
+        return parsedate_to_datetime(msg_headers['Date']).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return default
+
+def _download(source, run_dir, job):
+    """Скачивает Excel-вложение письма и, если нужно обработчику, его текст.
+
+    Выполняется в потоках пула; возвращает (путь, sha256, размер, текст).
+    """
+    uid, name, subject, msg_date, parts = job
+    excel_part = find_excel_part(parts)
+    # Скачиваются только нужные MIME-секции: вложение потоково, текст — по запросу
+    path, sha256, size = save_attachment(source, uid, excel_part, run_dir)
+    body = ""
+    text_part = find_text_part(parts) if HANDLERS[name]['body'] else None
+    if size and text_part:
+        raw = source.sections(uid, [text_part[0]]).get(text_part[0], b'')
+        body = decode_part(raw, text_part[4]).decode(
+            text_part[3].get('charset') or 'utf-8', 'ignore'
+        )
+    return path, sha256, size, body
+
+def _process(job, downloaded):
+    """Передаёт скачанное вложение обработчику отчёта.
+
+    Возвращает None, если вложение пустое, иначе результат обработки
+    (True также для уже загруженного ранее вложения).
+    """
+    uid, name, subject, msg_date, parts = job
+    if downloaded is None:
+        return False
+    path, sha256, size, body = downloaded
+    try:
+        if not size:
+            return None
+        # То же вложение уже загружено (повторная рассылка, пересланное письмо);
+        # у отчётов с датой в теме — за ту же дату
+        date_of = HANDLERS[name]['report_date']
+        if is_ingested(DB_PATH, sha256, name, date_of(subject) if date_of else None):
+            logging.info(f"⏭️ {name}: вложение уже загружено, пропуск ({subject})")
+            return True
+
+        filename = find_excel_part(parts)[5]
+        logging.info(f"📨 {name}: {subject} ({size / 1024:.0f} КБ)")
+        report = MailReport(str(uid), subject, msg_date, filename, path, body, sha256)
+        outcome = HANDLERS[name]['func'](report)
+        if outcome:
+            report_date, rows = outcome
+            record_ingested(DB_PATH, sha256, name, report.uid, report_date, rows)
+        return bool(outcome)
+    except Exception as e:
+        logging.error(f"❌ Ошибка обработчика {name}: {e}")
+        return False
+    finally:
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.warning(f"Не удалось удалить временный файл: {e}")
+
+def _job(uid, msg_headers, parts, names, default_date):
+    """Задание на загрузку, если письмо относится к одному из отчётов и содержит Excel"""
+    subject = decode_mime_words(msg_headers.get('Subject', ''))
+    name = match_report(subject, names)
+    if name is None or find_excel_part(parts) is None:
+        return None
+    return uid, name, subject, _message_date(msg_headers, default_date), parts
+
+def ingest(source, names=None):
+    """Один проход по источнику писем для всех (или выбранных) отчётов.
+
+    Для каждого отчёта обрабатывается последнее подходящее письмо с
+    Excel-вложением; вложения разных отчётов скачиваются параллельно через
+    пул соединений. Если для всех отчётов есть водяной знак, запрашиваются
+    только письма с UID выше него, иначе — за окно `days`. Возвращает
+    словарь {имя отчёта: результат}.
+    """
+    names = set(HANDLERS) if names is None else set(names) & set(HANDLERS)
+    results = {name: False for name in names}
+    if not names:
+        return results
+
+    peak_reset = reset_peak_memory()
+    source.open()
+    pool = SourcePool(source)
+    run_dir = tempfile.TemporaryDirectory(prefix='ingest_', dir=INGEST_TEMP_DIR)
+    try:
+        watermarks = load_watermarks(DB_PATH, source.uidvalidity)
+        now = datetime.now()
+        if all(name in watermarks for name in names):
+            uids = source.search(since_uid=min(watermarks[name] for name in names))
+        else:
+            days = max(HANDLERS[name]['days'] for name in names)
+            uids = source.search(since=(now - timedelta(days=days)).replace(hour=0, minute=0, second=0))
+        if not uids:
+            logging.info("📭 Нет новых писем")
+            return results
+
+        # Сначала только заголовки и структура всех писем, одним пакетным запросом
+        headers = source.headers(uids)
+
+        # Кандидаты по каждому отчёту, от новых к старым
+        candidates = {name: [] for name in names}
+        for uid in sorted(headers, reverse=True):
+            job = _job(uid, *headers[uid], names, now)
+            if job is None:
+                continue
+            name, msg_date = job[1], job[3]
+            if uid <= watermarks.get(name, 0):
+                continue
+            if msg_date < now - timedelta(days=HANDLERS[name]['days']):
+                continue
+            candidates[name].append(job)
+
+        failed = set()
+        # Берём по одному кандидату на отчёт; если вложение оказалось пустым — следующего
+        while True:
+            jobs = [candidates[name].pop(0) for name in sorted(candidates) if candidates[name]]
+            if not jobs:
+                break
+            downloads = pool.map(lambda conn, job: _download(conn, run_dir.name, job), jobs)
+            for job, downloaded in zip(jobs, downloads):
+                name = job[1]
+                result = _process(job, downloaded)
+                if result is None:
+                    continue
+                results[name] = result
+                del candidates[name]
+                if not result:
+                    failed.add(name)
+
+        for name in names:
+            if name in candidates:
+                logging.warning(f"❌ {name}: подходящее письмо не найдено")
+        # Просмотренные письма больше не запрашиваются; при ошибке обработки
+        # водяной знак не сдвигается, чтобы письмо было обработано повторно
+        save_watermarks(DB_PATH, source.uidvalidity, {
+            name: max(uids) for name in names if name not in failed
+        })
+        return results
+    finally:
+        pool.close()
+        source.close()
+        run_dir.cleanup()
+        log_peak_memory(peak_reset)
+
+def ingest_inbox(names=None, mail=None):
+    """ingest() по входящим IMAP; mail — уже открытая сессия, если есть"""
+    return ingest(ImapSource(mail), names)
+
+def replay(source, names=None, batch=FETCH_BATCH, sync_off=REPLAY_SYNC_OFF):
+    """Прогоняет все подходящие письма источника от старых к новым.
+
+    Используется для дозагрузки архива отчётов: окно дат и водяные знаки
+    не применяются, повторы отсекаются журналом вложений. Вложения
+    скачиваются параллельно через пул соединений, обработка идёт по
+    порядку UID. С sync_off запись идёт в режиме db.backfill().
+    Возвращает {имя отчёта: число успешно обработанных писем}.
+    """
+    if sync_off:
+        with db.backfill(db.get_connection(DB_PATH)):
+            return replay(source, names, batch, sync_off=False)
+    names = set(HANDLERS) if names is None else set(names) & set(HANDLERS)
+    counts = {name: 0 for name in names}
+    peak_reset = reset_peak_memory()
+    source.open()
+    pool = SourcePool(source)
+    run_dir = tempfile.TemporaryDirectory(prefix='replay_', dir=INGEST_TEMP_DIR)
+    try:
+        uids = sorted(source.search())
+        now = datetime.now()
+        for i in range(0, len(uids), batch):
+            headers = source.headers(uids[i:i + batch])
+            jobs = [job for job in (
+                _job(uid, *headers[uid], names, now) for uid in sorted(headers)
+            ) if job is not None]
+            downloads = pool.map(lambda conn, job: _download(conn, run_dir.name, job), jobs)
+            for job, downloaded in zip(jobs, downloads):
+                if _process(job, downloaded):
+                    counts[job[1]] += 1
+        return counts
+    finally:
+        pool.close()
+        source.close()
+        run_dir.cleanup()
+        log_peak_memory(peak_reset)
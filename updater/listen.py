@@ -0,0 +1,184 @@
+"""Постоянный слушатель почты: python -m updater.listen
+
+Держит IMAP-соединение в режиме IDLE и запускает обработчики отчётов, как
+только в ящике появляется новое письмо. Если сервер не поддерживает IDLE,
+ящик опрашивается раз в LISTEN_POLL_INTERVAL секунд. При любой ошибке
+переподключается с экспоненциальной задержкой.
+"""
+import os
+import sys
+import time
+import select
+import imaplib
+import logging
+from datetime import datetime
+from dotenv import load_dotenv
+
+import updater  # noqa: F401  регистрирует обработчики всех отчётов
+from updater.imap import connect_to_email
+from updater.inbox import ingest_inbox
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Сервер закрывает IDLE примерно через 30 минут, поэтому IDLE перезапускается раньше
+IDLE_TIMEOUT = int(os.getenv("LISTEN_IDLE_TIMEOUT", 300))
+MAX_BACKOFF = int(os.getenv("LISTEN_MAX_BACKOFF", 300))
+# Период опроса ящика, если сервер не поддерживает IDLE
+POLL_INTERVAL = int(os.getenv("LISTEN_POLL_INTERVAL", 60))
+HEARTBEAT_FILE = os.getenv("LISTEN_HEARTBEAT_FILE")
+
+
+class IdleRejected(imaplib.IMAP4.error):
+    """Сервер ответил на IDLE тегированным NO/BAD"""
+
+
+# imaplib (до Python 3.14) не умеет IDLE, поэтому команда отправляется
+# вручную: тег берётся из внутреннего mail._new_tag(), ответы читаются
+# mail.readline(). Всё обращение к внутренностям imaplib собрано здесь.
+def _readline(mail):
+    line = mail.readline()
+    if not line:
+        raise imaplib.IMAP4.abort("соединение закрыто сервером")
+    return line
+
+
+def _is_exists(line):
+    return line.startswith(b'*') and line.rstrip().upper().endswith(b'EXISTS')
+
+
+def _idle_start(mail):
+    """Отправляет IDLE и ждёт продолжения «+».
+
+    Возвращает (тег, было ли уведомление EXISTS до продолжения). При
+    тегированном ответе (NO/BAD) сессия остаётся в обычном состоянии и
+    выбрасывается IdleRejected.
+    """
+    tag = mail._new_tag()
+    mail.send(tag + b' IDLE\r\n')
+    has_new = False
+    while True:
+        line = _readline(mail)
+        if line.startswith(b'+'):
+            return tag, has_new
+        if line.startswith(tag + b' '):
+            raise IdleRejected(f"IDLE отклонён сервером: {line.decode(errors='replace').strip()}")
+        has_new = has_new or _is_exists(line)
+
+
+def _idle_done(mail, tag):
+    """Завершает IDLE (DONE) и дочитывает ответы до тегированного, который должен быть OK.
+
+    Возвращает True, если среди дочитанных строк было уведомление EXISTS:
+    сюда попадают и строки, уже лежавшие в буфере mail.file.
+    """
+    mail.send(b'DONE\r\n')
+    has_new = False
+    while True:
+        line = _readline(mail)
+        if line.startswith(tag + b' '):
+            status = line[len(tag):].split()[:1]
+            if status != [b'OK']:
+                raise imaplib.IMAP4.error(f"IDLE завершён с ошибкой: {line.decode(errors='replace').strip()}")
+            return has_new
+        has_new = has_new or _is_exists(line)
+
+
+def supports_idle(mail):
+    return 'IDLE' in getattr(mail, 'capabilities', ())
+
+
+def idle(mail, timeout):
+    """Команда IDLE (RFC 2177): ждёт уведомления не дольше timeout секунд.
+
+    Возвращает True, если сервер сообщил о новых письмах (EXISTS).
+
+    select() видит только сокет: строки, которые imaplib уже прочитал в
+    буфер mail.file вместе с предыдущей (например, EXPUNGE и EXISTS одним
+    пакетом), обнаруживаются не раньше DONE. Поэтому слушатель проверяет
+    ящик после каждого цикла IDLE, а не только по уведомлению.
+    """
+    tag, has_new = _idle_start(mail)
+    deadline = time.monotonic() + timeout
+    done = False
+    try:
+        while not has_new:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            # данные могут уже лежать в буфере SSL, тогда select их не увидит
+            pending = getattr(mail.sock, 'pending', lambda: 0)()
+            if not pending and not select.select([mail.sock], [], [], left)[0]:
+                break
+            has_new = _is_exists(_readline(mail))
+        has_new = _idle_done(mail, tag) or has_new
+        done = True
+    finally:
+        # при ошибке чтения сессию всё равно выводим из IDLE
+        if not done:
+            _idle_done(mail, tag)
+    return has_new
+
+
+def wait_for_mail(mail, use_idle):
+    """True, если стоит проверить ящик: по IDLE — при новом письме, без IDLE — каждый опрос"""
+    if use_idle:
+        return idle(mail, IDLE_TIMEOUT)
+    time.sleep(POLL_INTERVAL)
+    return True
+
+
+def heartbeat():
+    logging.info("💓 Слушатель почты активен")
+    if HEARTBEAT_FILE:
+        with open(HEARTBEAT_FILE, 'w') as f:
+            f.write(datetime.now().isoformat())
+
+
+def listen(names=None):
+    backoff = 1
+    while True:
+        mail = None
+        try:
+            mail = connect_to_email()
+            logging.info("✅ Подключение к почте успешно")
+            backoff = 1
+            use_idle = supports_idle(mail)
+            if not use_idle:
+                logging.info(f"Сервер не поддерживает IDLE: опрос раз в {POLL_INTERVAL} с")
+            # догоняем письма, пришедшие пока слушатель был выключен
+            ingest_inbox(names, mail=mail)
+            while True:
+                mail.select('inbox')
+                try:
+                    has_new = wait_for_mail(mail, use_idle)
+                except IdleRejected as e:
+                    logging.warning(f"{e}. Переход на опрос раз в {POLL_INTERVAL} с")
+                    use_idle = False
+                    continue
+                if has_new:
+                    logging.info("📨 Новое письмо")
+                # проход и по таймауту: уведомление могло застрять в буфере
+                # imaplib, а с водяными знаками пустой проход — один UID SEARCH
+                ingest_inbox(names, mail=mail)
+                heartbeat()
+        except (imaplib.IMAP4.error, OSError) as e:
+            logging.warning(f"❌ Потеряно соединение с почтой: {e}. Повтор через {backoff} с")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+        except Exception:
+            # ошибка загрузки (база заблокирована, сбой обработчика) не должна
+            # останавливать слушатель: переподключение и повтор с задержкой
+            logging.exception(f"❌ Ошибка при обработке почты. Повтор через {backoff} с")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+        finally:
+            if mail is not None:
+                try:
+                    mail.logout()
+                except Exception:
+                    pass
+
+
+if __name__ == "__main__":
+    listen(sys.argv[1:] or None)
@@ -1,13 +1,13 @@
 import base64
-import io
 import os
 import pickle
-import pandas as pd
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from datetime import datetime
 
+from updater.excel import Layout, read_report
+
 SCOPES = ['https://mail.google.com/']
 
 
@@ -29,47 +29,85 @@ def gmail_authenticate(auth_path):
     return build('gmail', 'v1', credentials=creds)
 
 
+# Тема и структура частей письма без их содержимого: по ним выбирается письмо
+# и находится вложение, не скачивая письма целиком
+_PART_FIELDS = 'partId,filename,mimeType,body(attachmentId,size)'
+MESSAGE_FIELDS = f'id,payload(headers(name,value),parts({_PART_FIELDS},parts({_PART_FIELDS})))'
+
+
+def get_messages(service, ids, fields=MESSAGE_FIELDS):
+    """Письма по списку id одним batch-запросом, в порядке ids"""
+    results = {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            print(f"Ошибка получения письма {request_id}: {exception}")
+            return
+        results[request_id] = response
+
+    batch = service.new_batch_http_request(callback=callback)
+    for message_id in ids:
+        batch.add(
+            service.users().messages().get(userId='me', id=message_id, format='full', fields=fields),
+            request_id=message_id
+        )
+    batch.execute()
+    return [results[i] for i in ids if i in results]
+
+
 def get_mail_id(service, subject):
+    """(id, тема, payload) последнего письма с subject в теме или None.
+
+    payload содержит только заголовки и структуру частей (MESSAGE_FIELDS).
+    """
     messages = service.users().messages().list(
         userId='me',
         labelIds=['INBOX'],
         q=f'subject:{subject}',
         maxResults=10
     ).execute().get('messages', [])
+    if not messages:
+        return None
 
-    for message in messages:
-        headers = service.users().messages().get(
-            userId='me', id=message['id']
-        ).execute()['payload']['headers']
-
-        for header in headers:
+    for message in get_messages(service, [m['id'] for m in messages]):
+        for header in message['payload'].get('headers', []):
             if header['name'] == 'Subject' and subject in header['value']:
-                return message['id'], header['value']
+                return message['id'], header['value'], message['payload']
     return None
 
 
-def get_file_by_mail_id(service, subject):
+def _walk_parts(payload):
+    for part in payload.get('parts', []):
+        yield part
+        yield from _walk_parts(part)
+
+
+def get_file_by_mail_id(service, subject, raw=False):
+    """(DataFrame, тема) из Excel-вложения последнего письма с subject в теме.
+
+    raw=True возвращает байты вложения как есть, без разбора: их можно
+    сохранить на диск или разобрать позже через read_report(data).
+    """
     result = get_mail_id(service, subject)
     if result is None:
         raise ValueError(f"Письмо с темой '{subject}' не найдено.")
-    
-    message_id, found_subject = result
-    message = service.users().messages().get(userId='me', id=message_id).execute()
-    parts = message['payload'].get('parts', [])
 
-    for part in parts:
+    message_id, found_subject, payload = result
+    for part in _walk_parts(payload):
         if part.get('filename') and part['filename'].endswith(('.xlsx', '.xls')):
-            if 'data' in part['body']:
-                data = part['body']['data']
-            else:
-                att_id = part['body']['attachmentId']
-                att = service.users().messages().attachments().get(
+            att_id = part['body'].get('attachmentId')
+            if att_id:
+                data = service.users().messages().attachments().get(
                     userId='me', messageId=message_id, id=att_id
-                ).execute()
-                data = att['data']
+                ).execute()['data']
+            else:
+                # небольшие части Gmail отдаёт прямо в письме, без attachmentId
+                message = service.users().messages().get(userId='me', id=message_id).execute()
+                data = next(p for p in _walk_parts(message['payload']) if p.get('partId') == part['partId'])['body']['data']
             file_data = base64.urlsafe_b64decode(data.encode('UTF-8'))
-            df = pd.read_excel(io.BytesIO(file_data))
-            return df, found_subject
+            if raw:
+                return file_data, found_subject
+            return read_report(file_data), found_subject
     raise ValueError("Вложение Excel не найдено в письме.")
 
 
@@ -79,17 +117,21 @@ def fetch_emails():
     subject = "Остатки по складам"  # Измени при необходимости
 
     service = gmail_authenticate(auth_path)
-    df, subject_found = get_file_by_mail_id(service, subject)
+    # вложение сохраняется как есть: без разбора и повторной записи через pandas,
+    # с оформлением и строками шапки, которые нужны prepare_stock_df
+    file_data, subject_found = get_file_by_mail_id(service, subject, raw=True)
 
     output_path = "/app/latest_report.xlsx" if os.path.exists("/app") else "latest_report.xlsx"
-    df.to_excel(output_path, index=False)
+    with open(f"{output_path}.tmp", "wb") as f:
+        f.write(file_data)
+    os.replace(f"{output_path}.tmp", output_path)
     print(f"Файл успешно сохранён: {output_path}, тема письма: {subject_found}")
 
 
 def process_stock_excel(filepath, report_date=None):
     """Обработка Excel-файла со складскими остатками"""
     try:
-        df = pd.read_excel(filepath, engine='openpyxl', header=None)  # Read without headers
+        df = read_report(filepath, Layout(header=None))  # Read without headers
         df = prepare_stock_df(df)  # Prepare the DataFrame
 
         # Strip whitespace from column names
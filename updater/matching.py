@@ -0,0 +1,108 @@
+import re
+from collections import defaultdict
+
+import numpy as np
+
+# rapidfuzz считает то же, что fuzzywuzzy, но на C и пачками; fuzzywuzzy — запасной вариант
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:
+    from fuzzywuzzy import fuzz
+    process = None
+
+# Минимальная оценка (0–100), ниже которой аналог не считается найденным
+MATCH_THRESHOLD = 60
+# Сколько кандидатов из индекса оценивать для одной строки
+CANDIDATE_LIMIT = 50
+# Длина n-грамм индекса
+NGRAM = 3
+# n-граммы, встречающиеся больше чем в этой доле записей, не отбирают кандидатов
+# (например, «ооо» в названиях клиентов)
+COMMON_GRAM_SHARE = 0.2
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def normalize(value):
+    """Строка для сравнения: слова в нижнем регистре, отсортированные по алфавиту.
+
+    fuzz.ratio на таких строках равен fuzz.token_sort_ratio на исходных,
+    но без кириллицы, выброшенной force_ascii в fuzzywuzzy.
+    """
+    if value is None:
+        return ''
+    return ' '.join(sorted(TOKEN_RE.findall(str(value).lower())))
+
+
+def ngrams(key, n=NGRAM):
+    grams = set()
+    for token in key.split():
+        padded = f" {token} "
+        grams.update(padded[i:i + n] for i in range(max(1, len(padded) - n + 1)))
+    return grams
+
+
+def score(key, choices):
+    """Оценки fuzz.ratio строки key против списка choices"""
+    if process is not None:
+        return process.cdist([key], choices, scorer=fuzz.ratio)[0].tolist()
+    return [fuzz.ratio(key, choice) for choice in choices]
+
+
+class Matcher:
+    """Нечёткий поиск по справочнику {строка: значение}.
+
+    Индекс n-грамм строится один раз; для каждой искомой строки оцениваются
+    только записи с общими n-граммами (не больше limit), а не весь справочник.
+    """
+
+    def __init__(self, choices: dict, threshold=MATCH_THRESHOLD, limit=CANDIDATE_LIMIT):
+        self.threshold = threshold
+        self.limit = limit
+        self._values = list(choices.values())
+        self._choices = list(choices)
+        self._keys = [normalize(choice) for choice in self._choices]
+        index = defaultdict(list)
+        for i, key in enumerate(self._keys):
+            for gram in ngrams(key):
+                index[gram].append(i)
+        self._index = {gram: np.array(ids, dtype=np.int32) for gram, ids in index.items()}
+        self._common = max(1, int(len(self._keys) * COMMON_GRAM_SHARE))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def candidates(self, key):
+        """Номера записей с наибольшим числом общих n-грамм"""
+        postings = [self._index[g] for g in ngrams(key) if g in self._index]
+        if not postings:
+            return []
+        rare = [p for p in postings if len(p) <= self._common]
+        counts = np.bincount(np.concatenate(rare or postings), minlength=len(self._keys))
+        ids = np.flatnonzero(counts)
+        if len(ids) > self.limit:
+            ids = ids[np.argpartition(counts[ids], -self.limit)[-self.limit:]]
+        return ids.tolist()
+
+    def best(self, query):
+        """(строка справочника, значение, оценка) или None, если оценка ниже порога"""
+        key = normalize(query)
+        if not key:
+            return None
+        ids = self.candidates(key)
+        if not ids:
+            return None
+        scores = score(key, [self._keys[i] for i in ids])
+        top = max(range(len(ids)), key=scores.__getitem__)
+        if scores[top] < self.threshold:
+            return None
+        i = ids[top]
+        return self._choices[i], self._values[i], scores[top]
+
+    def match(self, query):
+        found = self.best(query)
+        return found[1] if found else None
+
+    def match_many(self, queries):
+        """{строка: значение аналога или None} для уникальных строк"""
+        return {query: self.match(query) for query in dict.fromkeys(queries)}
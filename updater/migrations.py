@@ -0,0 +1,255 @@
+"""Версионированная схема базы.
+
+Номер применённой миграции хранится в PRAGMA user_version. Миграции
+применяются по порядку, каждая в своей транзакции, при первом соединении
+с базой в процессе (db.connect). Проверка планов запросов дашборда:
+
+    python -m updater.migrations
+"""
+import re
+import sys
+import logging
+
+from updater import db, rollups
+
+MIGRATIONS = []
+
+
+def migration(fn):
+    """Регистрирует миграцию; её номер — порядковый номер в модуле"""
+    MIGRATIONS.append(fn)
+    return fn
+
+
+def _table_exists(conn, table):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+# ------------------ Миграции ------------------
+@migration
+def create_tables(conn):
+    """Таблицы, которые раньше создавали сами загрузчики"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS sales (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        year INTEGER,
+        month INTEGER,
+        type TEXT,
+        client_code TEXT,
+        manager TEXT,
+        product_code TEXT,
+        product_name TEXT,
+        revenue REAL,
+        comment TEXT DEFAULT '0'
+    )''')
+    # комментарий отмечает строки, исправленные вручную (их загрузка не трогает)
+    if 'comment' not in _columns(conn, 'sales'):
+        conn.execute("ALTER TABLE sales ADD COLUMN comment TEXT DEFAULT '0'")
+    conn.execute('''CREATE TABLE IF NOT EXISTS stock_balance (
+        article TEXT,
+        nomenclature TEXT,
+        nomenclature_type TEXT,
+        warehouse TEXT,
+        quantity REAL,
+        value REAL,
+        date_updated TIMESTAMP,
+        report_date TEXT
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS purchases (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        supplier TEXT,
+        product TEXT,
+        quantity REAL,
+        price_per_unit REAL,
+        total REAL,
+        total_with_vat REAL,
+        report_date TEXT
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS production_exec (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        article TEXT,
+        nomenclature_desc TEXT,
+        plan REAL,
+        fact REAL,
+        date_updated TIMESTAMP
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS ingest_state (
+        report_type TEXT PRIMARY KEY,
+        uidvalidity INTEGER,
+        last_uid INTEGER,
+        updated_at TIMESTAMP
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS ingest_ledger (
+        sha256 TEXT,
+        report_type TEXT,
+        uid TEXT,
+        report_date TEXT,
+        rows INTEGER,
+        ingested_at TIMESTAMP,
+        PRIMARY KEY (sha256, report_type)
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS address_regions (
+        address_key TEXT PRIMARY KEY,
+        address TEXT,
+        region TEXT,
+        source TEXT,
+        resolved_at TIMESTAMP
+    )''')
+
+
+@migration
+def dashboard_indexes(conn):
+    """Покрывающие индексы под фильтры дашборда: запросы читают только индекс"""
+    # динамика продаж: type IN (...) GROUP BY year, month
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sales_type_period ON sales(type, year, month, revenue)")
+    # менеджер за год: итоги и список клиентов
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sales_manager_year "
+        "ON sales(manager, year, type, client_code, revenue)"
+    )
+    # товары клиента у менеджера за год
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sales_client_year "
+        "ON sales(client_code, year, manager, product_code, revenue)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_balance_date ON stock_balance(report_date, warehouse)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_date ON purchases(report_date)")
+    # справочники ведутся вне загрузчиков и могут отсутствовать
+    for table in ('clients', 'products'):
+        if _table_exists(conn, table):
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_code ON {table}(code)")
+
+
+@migration
+def sales_rollups(conn):
+    """Сводки продаж для дашборда (updater.rollups), заполняются по текущим данным"""
+    rollups.rebuild(conn)
+
+
+@migration
+def ledger_report_date(conn):
+    """Дата отчёта в ключе журнала вложений: одинаковый файл за разные даты
+    загружается для каждой даты"""
+    conn.execute('''CREATE TABLE ingest_ledger_new (
+        sha256 TEXT,
+        report_type TEXT,
+        uid TEXT,
+        report_date TEXT,
+        rows INTEGER,
+        ingested_at TIMESTAMP,
+        PRIMARY KEY (sha256, report_type, report_date)
+    )''')
+    conn.execute("INSERT INTO ingest_ledger_new SELECT * FROM ingest_ledger")
+    conn.execute("DROP TABLE ingest_ledger")
+    conn.execute("ALTER TABLE ingest_ledger_new RENAME TO ingest_ledger")
+
+
+@migration
+def rollup_triggers(conn):
+    """Триггеры sales отмечают изменённые срезы, чтобы сводки пересчитывались
+    и после записей вне загрузчика (бюджет, ручные правки)"""
+    rollups.create_triggers(conn)
+
+
+# ------------------ Применение ------------------
+def schema_version(conn=None):
+    return db.query_value("PRAGMA user_version", default=0, conn=conn)
+
+
+def migrate(conn=None):
+    """Применяет недостающие миграции, возвращает итоговую версию схемы"""
+    conn = conn or db.get_connection()
+    version = schema_version(conn)
+    for number, fn in enumerate(MIGRATIONS[version:], start=version + 1):
+        # IMMEDIATE: блокировка записи берётся до чтения версии, поэтому
+        # второй процесс ждёт (busy_timeout), а не падает на устаревшем снимке
+        with db.transaction(conn, immediate=True) as c:
+            # другой процесс мог применить миграцию, пока мы ждали блокировку
+            if schema_version(c) >= number:
+                continue
+            fn(c)
+            c.execute(f"PRAGMA user_version = {number}")
+        logging.info(f"🗄️ Миграция {number}: {fn.__name__}")
+    return max(version, len(MIGRATIONS))
+
+
+# ------------------ Планы запросов ------------------
+# Запросы дашборда, которые не должны читать таблицу целиком
+DASHBOARD_QUERIES = {
+    'Динамика продаж': ("""
+        SELECT year, month, type, revenue FROM sales_by_period
+        WHERE type IN ('Факт', 'Bdg')
+    """, ()),
+    'Менеджеры': ("SELECT DISTINCT manager FROM sales_by_manager WHERE manager IS NOT NULL AND manager != ''", ()),
+    'Итоги менеджера': ("""
+        SELECT SUM(CASE WHEN type = 'Bdg' THEN revenue ELSE 0 END),
+               SUM(CASE WHEN type = 'Факт' THEN revenue ELSE 0 END)
+        FROM sales_by_manager WHERE manager = ? AND year = ?
+    """, ('Менеджер', '2025')),
+    'Клиенты менеджера': ("""
+        SELECT client_code, SUM(CASE WHEN type = 'Факт' THEN revenue ELSE 0 END) AS fact
+        FROM sales_by_client WHERE manager = ? AND year = ?
+        GROUP BY client_code HAVING fact > 0 ORDER BY fact DESC
+    """, ('Менеджер', '2025')),
+    'Товары клиента': ("""
+        SELECT code_ap, SUM(revenue) AS total
+        FROM sales_by_client_product
+        WHERE client_code = ? AND manager = ? AND year = ?
+        GROUP BY code_ap ORDER BY total DESC
+    """, ('К-1', 'Менеджер', '2025')),
+    # пересчёт сводок при загрузке
+    'Срез продаж': ("SELECT manager, client_code, product_code, revenue FROM sales WHERE type = ? AND year = ?",
+                    ('Факт', 2025)),
+    'Даты остатков': ("SELECT DISTINCT report_date FROM stock_balance ORDER BY report_date DESC", ()),
+    'Остатки на дату': ("""
+        SELECT warehouse, nomenclature_type, article, quantity, value
+        FROM stock_balance WHERE report_date = ?
+    """, ('2025-01-01',)),
+    'Закупки': ("SELECT * FROM purchases ORDER BY report_date DESC", ()),
+}
+
+# Полный проход таблицы без индекса: "SCAN sales" (в старых SQLite "SCAN TABLE sales")
+FULL_SCAN_RE = re.compile(r'^SCAN (TABLE )?(\w+)( AS \w+)?$')
+
+
+def explain(sql, params=(), conn=None):
+    """Строки EXPLAIN QUERY PLAN запроса"""
+    return [row[3] for row in db.query_all(f"EXPLAIN QUERY PLAN {sql}", params, conn)]
+
+
+def check_query_plans(conn=None, queries=None):
+    """{запрос: строки плана с полным проходом таблицы} для запросов дашборда.
+
+    Запросы к отсутствующим таблицам (например, products) пропускаются.
+    """
+    conn = conn or db.get_connection()
+    problems = {}
+    for name, (sql, params) in (queries or DASHBOARD_QUERIES).items():
+        tables = set(re.findall(r'(?:FROM|JOIN)\s+(\w+)', sql))
+        if not all(_table_exists(conn, table) for table in tables):
+            continue
+        plan = explain(sql, params, conn)
+        logging.info(f"{name}: " + "; ".join(plan))
+        scans = [line for line in plan if FULL_SCAN_RE.match(line)]
+        if scans:
+            problems[name] = scans
+    return problems
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    conn = db.connect(argv[0]) if argv else db.get_connection()
+    logging.info(f"Версия схемы: {schema_version(conn)}")
+    problems = check_query_plans(conn)
+    for name, scans in problems.items():
+        logging.error(f"❌ {name}: полный проход ({'; '.join(scans)})")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
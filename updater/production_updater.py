@@ -1,65 +1,41 @@
 import os
 import pandas as pd
-import sqlite3
 from datetime import datetime
-import imaplib
-import email
-from email.header import decode_header
 import re
+import logging
 from dotenv import load_dotenv
 import numpy as np
-from openpyxl import load_workbook
+
+from updater import analytics, db
+from updater.cache import read_cached, store_cached
+from updater.excel import Layout, read_report
+from updater.inbox import report_handler, ingest_inbox
 
 # Загрузка переменных окружения
 load_dotenv()
+DB_PATH = os.getenv("DB_PATH", "db.db")
 
-# ------------------ Почтовые утилиты ------------------
-def get_email_credentials():
-    user = os.getenv("EMAIL_USER")
-    pwd  = os.getenv("EMAIL_PASSWORD")
-    srv  = os.getenv("EMAIL_SERVER", "imap.gmail.com")
-    missing = [v for v in ("EMAIL_USER","EMAIL_PASSWORD","EMAIL_SERVER") if not os.getenv(v)]
-    if missing:
-        raise RuntimeError(f"Не найдены переменные окружения: {', '.join(missing)}.")
-    return user, pwd, srv
+# ------------------ Работа с производством ------------------
+# Меняется при любом изменении разбора — старые записи кэша перестают использоваться
+PROD_PARSER_VERSION = 1
 
-def connect_to_email():
-    user, pwd, srv = get_email_credentials()
-    mail = imaplib.IMAP4_SSL(srv)
-    mail.login(user, pwd)
-    return mail
+# Новая выгрузка загружается в PROD_STAGING и подменяет PROD_TABLE целиком;
+# предыдущая выгрузка остаётся в PROD_PREVIOUS
+PROD_TABLE = 'production_exec'
+PROD_STAGING = 'production_exec_new'
+PROD_PREVIOUS = 'production_exec_prev'
+PROD_COLUMNS = ['article', 'nomenclature_desc', 'plan', 'fact', 'date_updated']
+
+
+def process_prod_excel(path, sha256=None):
+    # Разобранный ранее файл берём из кэша
+    df = read_cached('production', PROD_PARSER_VERSION, sha256)
+    if df is not None:
+        df['date_updated'] = datetime.now()
+        return df
 
-# ------------------ Работа с производством ------------------
-def get_latest_prod_excel():
-    mail = connect_to_email()
-    mail.select('inbox')
-    since=(datetime.now()-pd.Timedelta(days=14)).strftime("%d-%b-%Y")
-    _,msgs=mail.search(None,'SINCE',since)
-    if not msgs[0]: return None
-    for eid in msgs[0].split()[::-1]:
-        _,data=mail.fetch(eid,'(RFC822)')
-        msg=email.message_from_bytes(data[0][1])
-        subj,enc=decode_header(msg.get('Subject',''))[0]
-        if isinstance(subj,bytes): subj=subj.decode(enc or 'utf-8')
-        if 'исполнение производства' in subj.lower():
-            for part in msg.walk():
-                if part.get_content_maintype()=='multipart': continue
-                if not part.get('Content-Disposition'): continue
-                filename = part.get_filename()
-                if not filename: continue
-                fn, enc2 = decode_header(filename)[0]
-                if isinstance(fn,bytes): fn = fn.decode(enc2 or 'utf-8')
-                if fn.lower().endswith(('.xls','.xlsx')):
-                    os.makedirs('temp',exist_ok=True)
-                    path=os.path.join('temp',fn)
-                    with open(path,'wb') as f: f.write(part.get_payload(decode=True))
-                    return path
-    return None
-
-
-def process_prod_excel(path):
     # Читаем Excel с учетом трехстрочного заголовка
-    df_raw = pd.read_excel(path, header=[0,1,2])
+    df_raw = read_report(path, Layout(header=[0,1,2]))
 
     # Плоский список имен колонок: объединяем все уровни в строку
     new_cols = []
@@ -98,41 +74,63 @@ def process_prod_excel(path):
     # Приведение к числам
     df['plan'] = pd.to_numeric(df['plan'], errors='coerce').fillna(0)
     df['fact'] = pd.to_numeric(df['fact'], errors='coerce').fillna(0)
+    store_cached('production', PROD_PARSER_VERSION, sha256, df)
     df['date_updated'] = datetime.now()
     return df
 
 
-def update_production_data():
-    # Пытаемся найти и сохранить файл исполнения производства
-    path = get_latest_prod_excel()
-    print(f"Production file path: {path}")
-    if not path:
-        print("Не найдено писем с исполнением производства")
-        return False
+@report_handler('production', 'исполнение производства', days=14)
+def handle_production_report(report):
+    print(f"Production file path: {report.path}")
     # Обработка файла
-    df = process_prod_excel(path)
+    df = process_prod_excel(report.path, report.sha256)
     # Обновление базы данных
-    conn = sqlite3.connect('db.db')
-    # Создаем или очищаем таблицу
-    conn.execute('DROP TABLE IF EXISTS production_exec')
-    conn.execute('''
-        CREATE TABLE production_exec(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            article TEXT,
-            nomenclature_desc TEXT,
-            plan REAL,
-            fact REAL,
-            date_updated TIMESTAMP
-        )
-    ''')
-    df_to_save = df[['article','nomenclature_desc','plan','fact','date_updated']]
-    df_to_save.to_sql('production_exec', conn, if_exists='append', index=False)
-    conn.commit()
-    conn.close()
-    # Удаляем временный файл
-    try:
-        os.remove(path)
-    except Exception as e:
-        print(f"Не удалось удалить временный файл: {e}")
+    df_to_save = df[PROD_COLUMNS]
+    replace_production(df_to_save)
     print("Production table has been updated.")
+    return datetime.now().strftime('%Y-%m-%d'), len(df_to_save)
+
+
+def replace_production(df, db_path=DB_PATH):
+    """Загружает выгрузку в промежуточную таблицу и подменяет ею production_exec.
+
+    Дашборд во время загрузки читает прежнюю таблицу, после подмены — новую.
+    """
+    conn = db.get_connection(db_path)
+    with db.transaction(conn, immediate=True):
+        conn.execute(f"DROP TABLE IF EXISTS {PROD_STAGING}")
+        # та же схема, что у production_exec (создаётся миграцией)
+        sql = db.query_value(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (PROD_TABLE,), conn=conn
+        )
+        conn.execute(sql.replace(PROD_TABLE, PROD_STAGING, 1))
+        db.insert_df(conn, PROD_STAGING, df)
+    db.swap_tables(conn, PROD_TABLE, PROD_STAGING, PROD_PREVIOUS)
+    analytics.store(PROD_TABLE, db_path=db_path)
+
+
+def rollback_production(db_path=DB_PATH):
+    """Возвращает предыдущую выгрузку; текущая остаётся в промежуточной таблице.
+
+    Откатиться можно на одну выгрузку назад: если предыдущей нет (ещё не
+    было подмены или откат уже выполнен), возвращает False.
+    """
+    conn = db.get_connection(db_path)
+    with db.transaction(conn, immediate=True):
+        previous = db.query_one(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (PROD_PREVIOUS,), conn=conn
+        )
+        if previous is None:
+            logging.warning("Нет предыдущей выгрузки производства для отката")
+            return False
+        db.swap_tables(conn, PROD_TABLE, PROD_PREVIOUS, PROD_STAGING)
+    analytics.store(PROD_TABLE, db_path=db_path)
+    return True
+
+
+def update_production_data():
+    # Пытаемся найти и обработать файл исполнения производства
+    if not ingest_inbox(['production'])['production']:
+        print("Не найдено писем с исполнением производства")
+        return False
     return True
@@ -1,34 +1,18 @@
 import os
+import numpy as np
 import pandas as pd
-import sqlite3
 from datetime import datetime
-import imaplib
-import email
-from email.header import decode_header
-import tempfile
-from openpyxl import load_workbook
 import logging
 from dotenv import load_dotenv
 
+from updater import analytics, db
+from updater.excel import Layout, iter_report
+from updater.inbox import report_handler, ingest_inbox
+
 load_dotenv()
+DB_PATH = os.getenv("DB_PATH", "db.db")
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-# ------------------ Почтовые утилиты ------------------
-def get_email_credentials():
-    user = os.getenv("EMAIL_USER")
-    pwd  = os.getenv("EMAIL_PASSWORD")
-    srv  = os.getenv("EMAIL_SERVER", "imap.gmail.com")
-    missing = [v for v in ("EMAIL_USER","EMAIL_PASSWORD","EMAIL_SERVER") if not os.getenv(v)]
-    if missing:
-        raise RuntimeError(f"Не найдены переменные окружения: {', '.join(missing)}.")
-    return user, pwd, srv
-
-def connect_to_email():
-    user, pwd, srv = get_email_credentials()
-    mail = imaplib.IMAP4_SSL(srv)
-    mail.login(user, pwd)
-    return mail
-
 def extract_date_from_subject(subject):
     try:
         for part in subject.split():
@@ -40,144 +24,65 @@ def extract_date_from_subject(subject):
         pass
     return datetime.now().strftime("%Y-%m-%d")
 
-def decode_mime_words(s):
-    decoded_fragments = decode_header(s)
-    return ''.join([
-        fragment.decode(encoding or 'utf-8') if isinstance(fragment, bytes) else fragment
-        for fragment, encoding in decoded_fragments
-    ])
-
-def find_latest_purchase_file():
+# Колонки листа закупок по порядку (данные начинаются с 3-й строки)
+PURCHASE_COLUMNS = ['product', 'supplier', 'quantity', 'price_per_unit', 'total', 'total_with_vat']
+PURCHASE_LAYOUT = Layout(columns=PURCHASE_COLUMNS, min_row=3)
+PURCHASE_DB_COLUMNS = ['supplier', 'product', 'quantity', 'price_per_unit', 'total', 'total_with_vat', 'report_date']
+
+def clean_purchases_df(df, report_date):
+    """Отбрасывает строки без поставщика, товара или числового количества"""
+    valid = (
+        df['supplier'].notna() & (df['supplier'] != '') & (df['supplier'] != 0)
+        & df['product'].notna() & (df['product'] != '') & (df['product'] != 0)
+        & df['quantity'].notna()
+        & df['quantity'].map(lambda v: isinstance(v, (int, float, np.number)) and not isinstance(v, (bool, np.bool_)))
+    )
+    df = df[valid].copy()
+    df['supplier'] = df['supplier'].astype(str).str.strip()
+    df['product'] = df['product'].astype(str).str.strip()
+    df['quantity'] = df['quantity'].astype(float)
+    for col in ('price_per_unit', 'total', 'total_with_vat'):
+        df[col] = pd.to_numeric(df[col].replace('', 0), errors='coerce').fillna(0)
+    df['report_date'] = report_date
+    return df[PURCHASE_DB_COLUMNS]
+
+@report_handler('purchases', 'закупк', days=14, report_date=extract_date_from_subject)
+def handle_purchases_report(report):
     try:
-        logging.info("Подключение к почте...")
-        mail = connect_to_email()
-        logging.info("✅ Подключение к почте успешно")
-
-        mail.select("inbox")
-        logging.info("🔍 Поиск писем с темой, содержащей 'закупк'...")
-        result, data = mail.search(None, "ALL")
-        if result != "OK":
-            logging.warning("❌ Не удалось получить письма")
-            return None, None
-
-        email_ids = data[0].split()[::-1][:10]
-        logging.info(f"📨 Проверяем последние {len(email_ids)} писем")
-
-        for eid in email_ids:
-            result, msg_data = mail.fetch(eid, "(RFC822)")
-            if result != "OK":
-                continue
-
-            msg = email.message_from_bytes(msg_data[0][1])
-            subject_raw = msg.get("Subject", "")
-            subject = decode_mime_words(subject_raw)
-
-            if "закупк" not in subject.lower():
-                continue
-
-            logging.info(f"📦 Найдено письмо с темой: {subject}")
-
-            for part in msg.walk():
-                if part.get_content_maintype() == "multipart":
+        logging.info(f"📦 Найдено письмо с темой: {report.subject}")
+        report_date = extract_date_from_subject(report.subject)
+
+        conn = db.get_connection(DB_PATH)
+        # Книга читается потоково во временную таблицу; блокировка записи
+        # базы берётся только на замену раздела
+        with db.staging(conn, 'purchases', PURCHASE_DB_COLUMNS) as staged:
+            rows = 0
+            for batch in iter_report(report.path, PURCHASE_LAYOUT):
+                df = clean_purchases_df(batch, report_date)
+                if df.empty:
                     continue
-                if part.get("Content-Disposition") is None:
-                    continue
-
-                filename_raw = part.get_filename()
-                if not filename_raw:
-                    continue
-                filename = decode_mime_words(filename_raw)
-
-                if filename.lower().endswith((".xls", ".xlsx")):
-                    logging.info(f"⬇️ Скачивание вложения: {filename}")
-                    payload = part.get_payload(decode=True)
-                    if not payload:
-                        continue
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
-                        tmp.write(payload)
-                        return tmp.name, subject
-
-        logging.warning("📭 Не найден подходящий файл вложения в письмах")
-        return None, None
-
-    except Exception as e:
-        logging.error(f"❌ Ошибка в find_latest_purchase_file: {e}")
-        return None, None
-
-def update_purchases_data():
-    DB_PATH = r"C:\\Users\\user\\Desktop\\Проекты\\projects\\sales_airflow_project\\db.db"
-
-    try:
-        logging.info("Поиск последнего файла закупок...")
-        path, subj = find_latest_purchase_file()
-        if not path:
-            logging.warning("📭 Файл закупок не найден")
-            return False
-
-        report_date = extract_date_from_subject(subj)
-        wb = load_workbook(path, data_only=True)
-        ws = wb.active
-
-        header = [str(cell.value).strip().lower() if cell.value else "" for cell in ws[1]]
-        col_map = {
-            'поставщик': 1,
-            'номенклатура': 0,
-            'кол-во': 2,
-            'цена': 3,
-            'сумма': 4,
-            'сумма с ндс': 5
-        }
-
-        data = []
-        for row in ws.iter_rows(min_row=3, values_only=True):
-            supplier = row[col_map['поставщик']]
-            product = row[col_map['номенклатура']]
-            quantity = row[col_map['кол-во']]
-            price_per_unit = row[col_map['цена']]
-            total = row[col_map['сумма']]
-            total_with_vat = row[col_map['сумма с ндс']]
-
-            if not supplier or not product or not isinstance(quantity, (int, float)):
-                continue
-
-            data.append({
-                "supplier": str(supplier).strip(),
-                "product": str(product).strip(),
-                "quantity": quantity,
-                "price_per_unit": price_per_unit or 0,
-                "total": total or 0,
-                "total_with_vat": total_with_vat or 0,
-                "report_date": report_date
-            })
-
-        if not data:
-            logging.warning("❌ Нет данных для обновления закупок")
-            return False
-
-        df = pd.DataFrame(data)
-        logging.info("🔧 Создание таблицы purchases при необходимости...")
-        conn = sqlite3.connect(DB_PATH)
-        conn.execute('''CREATE TABLE IF NOT EXISTS purchases (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            supplier TEXT,
-            product TEXT,
-            quantity REAL,
-            price_per_unit REAL,
-            total REAL,
-            total_with_vat REAL,
-            report_date TEXT
-        )''')
-        logging.info("📥 Добавление данных...")
-        df.to_sql('purchases', conn, if_exists='append', index=False)
-        conn.commit()
-        conn.close()
-        os.remove(path)
+                db.insert_df(conn, staged, df, immediate=False)
+                rows += len(df)
+            if not rows:
+                # пустой отчёт не должен стирать закупки, загруженные ранее
+                logging.warning("❌ Нет данных для обновления закупок")
+                return False
+            logging.info("📥 Добавление данных...")
+            with db.transaction(conn, immediate=True):
+                # Повторная загрузка отчёта за ту же дату заменяет прежнюю
+                db.delete_partitions(conn, 'purchases', ['report_date'], [(report_date,)])
+                db.insert_staged(conn, 'purchases', staged)
+        analytics.store('purchases', [(report_date,)], DB_PATH)
         logging.info("✅ Закупки обновлены")
-        return True
+        return report_date, rows
 
     except Exception as e:
         logging.error(f"❌ Ошибка при обновлении закупок: {e}")
         return False
 
+def update_purchases_data():
+    logging.info("Поиск последнего файла закупок...")
+    return ingest_inbox(['purchases'])['purchases']
+
 if __name__ == "__main__":
     update_purchases_data()
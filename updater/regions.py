@@ -0,0 +1,155 @@
+import os
+import logging
+import importlib.util
+from datetime import datetime
+from dotenv import load_dotenv
+
+from updater import db
+from updater.matching import TOKEN_RE, Matcher
+
+load_dotenv()
+
+DB_PATH = os.getenv("DB_PATH", "db.db")
+DADATA_TOKEN = os.getenv("DADATA_TOKEN")
+DADATA_SECRET = os.getenv("DADATA_SECRET")
+# dadata — через API Dadata, dictionary — по справочнику regions без сети;
+# по умолчанию Dadata, если задан токен
+REGION_BACKEND = os.getenv("REGION_BACKEND")
+# Сколько адресов передавать источнику за раз
+REGION_BATCH = int(os.getenv("REGION_BATCH", 100))
+
+# Части адреса, которые не помогают определить регион
+ADDRESS_STOPWORDS = {
+    'г', 'гор', 'город', 'ул', 'улица', 'д', 'дом', 'к', 'корп', 'стр', 'кв', 'оф',
+    'пр', 'пр-т', 'проспект', 'пер', 'ш', 'шоссе', 'мкр', 'р-н', 'район', 'п', 'пос',
+    'с', 'село', 'дер', 'рф', 'россия',
+}
+
+
+def normalize_address(address):
+    """Ключ адреса для кэша: слова в нижнем регистре, ё -> е. None для пустых адресов"""
+    if address is None:
+        return None
+    key = ' '.join(TOKEN_RE.findall(str(address).lower().replace('ё', 'е')))
+    return key if any(c.isalpha() for c in key) else None
+
+
+# ------------------ Источники регионов ------------------
+# Источник — вызываемый объект: список адресов -> список регионов (None, если
+# регион не определён) той же длины.
+
+class DictionaryResolver:
+    """Без сети: ищет в частях адреса (через запятую) ближайшее название из справочника"""
+
+    name = 'dictionary'
+
+    def __init__(self, regions):
+        self.matcher = Matcher({region: region for region in regions})
+
+    def resolve(self, address):
+        best = None
+        for part in str(address).split(','):
+            words = [w for w in TOKEN_RE.findall(part.lower()) if w not in ADDRESS_STOPWORDS]
+            found = self.matcher.best(' '.join(words)) if words else None
+            if found and (best is None or found[2] > best[2]):
+                best = found
+        return best[1] if best else None
+
+    def __call__(self, addresses):
+        return [self.resolve(address) for address in addresses]
+
+
+class DadataResolver:
+    """Регион из стандартизации адреса Dadata (clean, нужен секретный ключ)
+    или из подсказок (suggest), если ключа нет.
+
+    Если задан справочник regions, ответ Dadata приводится к его названиям.
+    """
+
+    name = 'dadata'
+
+    def __init__(self, token=DADATA_TOKEN, secret=DADATA_SECRET, regions=None):
+        from dadata import Dadata
+
+        self.client = Dadata(token, secret)
+        self.use_clean = bool(secret)
+        self.canonical = DictionaryResolver(regions) if regions else None
+
+    def resolve(self, address):
+        if self.use_clean:
+            data = self.client.clean("address", address)
+        else:
+            suggestions = self.client.suggest("address", address, count=1)
+            data = suggestions[0]["data"] if suggestions else None
+        region = (data or {}).get("region_with_type")
+        if region and self.canonical:
+            region = self.canonical.resolve(region)
+        return region
+
+    def __call__(self, addresses):
+        return [self.resolve(address) for address in addresses]
+
+
+def load_regions(db_path=DB_PATH):
+    rows = db.query_all(
+        "SELECT DISTINCT region FROM regions WHERE region IS NOT NULL", conn=db.get_connection(db_path)
+    )
+    return [row[0] for row in rows]
+
+
+def region_resolver(db_path=DB_PATH, backend=REGION_BACKEND):
+    """Источник регионов по REGION_BACKEND (или Dadata, если задан токен и установлен пакет)"""
+    if backend is None:
+        has_dadata = DADATA_TOKEN and importlib.util.find_spec('dadata') is not None
+        backend = 'dadata' if has_dadata else 'dictionary'
+    if backend == 'dadata':
+        return DadataResolver(regions=load_regions(db_path))
+    if backend == 'dictionary':
+        return DictionaryResolver(load_regions(db_path))
+    raise ValueError(f"Неизвестный источник регионов: {backend}")
+
+
+# ------------------ Кэш ------------------
+def _cached(conn, keys):
+    found = {}
+    keys = list(keys)
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        found.update(db.query_all(
+            f"SELECT address_key, region FROM address_regions "
+            f"WHERE address_key IN ({','.join('?' * len(chunk))})",
+            chunk, conn
+        ))
+    return found
+
+
+def resolve_regions(addresses, resolver, db_path=DB_PATH, batch=REGION_BATCH):
+    """{адрес: регион или None} для списка адресов.
+
+    Каждый адрес (после normalize_address) отправляется в источник один раз
+    за всё время жизни базы: ответ, в том числе «не найден», сохраняется в
+    address_regions. При ошибке источника оставшиеся адреса остаются без
+    региона и будут запрошены при следующей загрузке.
+    """
+    keys = {address: normalize_address(address) for address in dict.fromkeys(addresses)}
+    conn = db.get_connection(db_path)
+    regions = _cached(conn, {key for key in keys.values() if key})
+    todo = {}
+    for address, key in keys.items():
+        if key and key not in regions:
+            todo.setdefault(key, address)
+    if todo:
+        logging.info(f"🗺️ Определение регионов: {len(todo)} новых адресов ({resolver.name})")
+    todo = list(todo.items())
+    for i in range(0, len(todo), batch):
+        chunk = todo[i:i + batch]
+        try:
+            found = resolver([address for _, address in chunk])
+        except Exception as e:
+            logging.warning(f"Не удалось определить регионы: {e}")
+            break
+        now = datetime.now()
+        rows = [(key, address, region, resolver.name, now) for (key, address), region in zip(chunk, found)]
+        db.executemany("INSERT OR IGNORE INTO address_regions VALUES (?, ?, ?, ?, ?)", rows, conn)
+        regions.update((key, region) for key, _, region, _, _ in rows)
+    return {address: regions.get(key) for address, key in keys.items()}
@@ -0,0 +1,33 @@
+"""Прогон архива писем через загрузку отчётов:
+
+    python -m updater.replay <каталог Maildir или папка .eml> [отчёт ...]
+
+Письма обрабатываются от старых к новым тем же кодом, что и почта, поэтому
+подходит для дозагрузки истории и воспроизводимых замеров без доступа к
+почтовому ящику.
+"""
+import sys
+import time
+import logging
+
+import updater  # noqa: F401  регистрирует обработчики всех отчётов
+from updater.inbox import replay
+from updater.sources import FolderSource
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+def main(argv):
+    if not argv:
+        print(__doc__)
+        return 1
+    started = time.perf_counter()
+    counts = replay(FolderSource(argv[0]), argv[1:] or None)
+    for name, count in sorted(counts.items()):
+        logging.info(f"{name}: обработано писем {count}")
+    logging.info(f"⏱️ Время: {time.perf_counter() - started:.1f} с")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,139 @@
+"""Сводные таблицы продаж для дашборда.
+
+Сводки пересчитываются при загрузке только для затронутых периодов, поэтому
+страница «Динамика продаж» читает их, а не всю таблицу sales. Любое
+изменение sales — и загрузчиком, и вне его (бюджет Bdg, ручные правки) —
+триггеры отмечают в rollup_dirty; отмеченные срезы пересчитывает загрузка
+продаж или дашборд перед чтением сводок (refresh_dirty). Полный пересчёт
+(после обновления справочника products):
+
+    python -m updater.rollups
+"""
+import logging
+
+from updater import db
+
+# Сводка: ключевые колонки и SELECT из sales, группирующий по ним.
+# Параметры SELECT — (type, year): пересчитывается срез по типу и году.
+ROLLUPS = {
+    'sales_by_period': (
+        ['year', 'month', 'type'],
+        """SELECT year, month, type, SUM(revenue)
+           FROM sales WHERE type = ? AND year = ?
+           GROUP BY year, month, type"""
+    ),
+    'sales_by_manager': (
+        ['manager', 'year', 'type'],
+        """SELECT manager, year, type, SUM(revenue)
+           FROM sales WHERE type = ? AND year = ?
+           GROUP BY manager"""
+    ),
+    'sales_by_client': (
+        ['manager', 'year', 'type', 'client_code'],
+        """SELECT manager, year, type, client_code, SUM(revenue)
+           FROM sales WHERE type = ? AND year = ?
+           GROUP BY manager, client_code"""
+    ),
+    'sales_by_client_product': (
+        ['client_code', 'manager', 'year', 'type', 'code_ap'],
+        """SELECT s.client_code, s.manager, s.year, s.type, {code_ap}, SUM(s.revenue)
+           FROM sales s {join} WHERE s.type = ? AND s.year = ?
+           GROUP BY s.client_code, s.manager, {code_ap}"""
+    ),
+}
+
+
+# Типы колонок как в sales: дашборд передаёт год строкой, INTEGER приводит его к числу
+COLUMN_TYPES = {'year': 'INTEGER', 'month': 'INTEGER'}
+
+
+def create_tables(conn):
+    for table, (keys, _) in ROLLUPS.items():
+        columns = ', '.join(f"{key} {COLUMN_TYPES.get(key, 'TEXT')}" for key in keys)
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ({columns}, revenue REAL, "
+            f"PRIMARY KEY ({', '.join(keys)}))"
+        )
+        # по срезу (тип, год) сводки пересчитываются
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_slice ON {table}(type, year)")
+
+
+# Срезы (тип, год), изменившиеся в sales после последнего пересчёта сводок
+DIRTY_TABLE = 'rollup_dirty'
+# Колонки sales, от которых зависят сводки
+TRACKED_COLUMNS = ['year', 'month', 'type', 'client_code', 'manager', 'product_code', 'revenue']
+
+
+def create_triggers(conn):
+    """Триггеры sales, отмечающие изменённые срезы в rollup_dirty"""
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {DIRTY_TABLE} "
+        "(type TEXT, year INTEGER, PRIMARY KEY (type, year)) WITHOUT ROWID"
+    )
+    # строки без типа или года в сводки не попадают
+    mark = (f"INSERT OR IGNORE INTO {DIRTY_TABLE} SELECT {{row}}.type, {{row}}.year "
+            "WHERE {row}.type IS NOT NULL AND {row}.year IS NOT NULL;")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS sales_rollup_insert AFTER INSERT ON sales
+        BEGIN {mark.format(row='NEW')} END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS sales_rollup_delete AFTER DELETE ON sales
+        BEGIN {mark.format(row='OLD')} END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS sales_rollup_update
+        AFTER UPDATE OF {', '.join(TRACKED_COLUMNS)} ON sales
+        BEGIN {mark.format(row='OLD')} {mark.format(row='NEW')} END""")
+
+
+def _select(conn, sql):
+    # код продукции берётся из справочника products, если он есть
+    has_products = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products'"
+    ).fetchone()
+    if has_products:
+        return sql.format(code_ap='p.code_ap', join='LEFT JOIN products p ON s.product_code = p.code')
+    return sql.format(code_ap='NULL', join='')
+
+
+def refresh(conn, partitions=()):
+    """Пересчитывает сводки для периодов (year, month, type) последней загрузки
+    и для срезов, отмеченных в rollup_dirty.
+
+    Вызывается в транзакции загрузки, чтобы сводки менялись вместе с sales.
+    """
+    slices = {(type_, year) for year, month, type_ in partitions}
+    with db.transaction(conn, immediate=True):
+        slices |= set(conn.execute(f"SELECT type, year FROM {DIRTY_TABLE}").fetchall())
+        for table, (keys, sql) in ROLLUPS.items():
+            select = _select(conn, sql)
+            columns = ', '.join(keys + ['revenue'])
+            for type_, year in slices:
+                conn.execute(f"DELETE FROM {table} WHERE type = ? AND year = ?", (type_, year))
+                conn.execute(f"INSERT INTO {table} ({columns}) {select}", (type_, year))
+        conn.execute(f"DELETE FROM {DIRTY_TABLE}")
+    return len(slices)
+
+
+def refresh_dirty(conn=None):
+    """Пересчитывает срезы, изменённые вне загрузки продаж (бюджет, ручные
+    правки); без изменений — один запрос к пустой rollup_dirty"""
+    conn = conn or db.get_connection()
+    if db.query_one(f"SELECT 1 FROM {DIRTY_TABLE} LIMIT 1", conn=conn) is None:
+        return 0
+    slices = refresh(conn)
+    logging.info(f"📊 Сводки пересчитаны после изменений sales: {slices} срезов (тип, год)")
+    return slices
+
+
+def rebuild(conn=None):
+    """Полный пересчёт сводок по всем периодам sales"""
+    conn = conn or db.get_connection()
+    with db.transaction(conn, immediate=True):
+        create_tables(conn)
+        create_triggers(conn)
+        for table in ROLLUPS:
+            conn.execute(f"DELETE FROM {table}")
+        slices = conn.execute("SELECT DISTINCT year, 0, type FROM sales").fetchall()
+        return refresh(conn, slices)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    logging.info(f"📊 Сводки пересчитаны: {rebuild()} срезов (тип, год)")
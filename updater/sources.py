@@ -0,0 +1,276 @@
+import os
+import zlib
+import queue
+import logging
+import threading
+import email
+import email.message
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from email.parser import BytesHeaderParser
+from email.utils import parsedate_to_datetime
+
+from updater.imap import (
+    STREAM_CHUNK, connect_to_email, decode_mime_words, fetch_headers,
+    fetch_section_chunks, fetch_sections, search_uids, walk_structure
+)
+
+# Число соединений для параллельной загрузки вложений
+IMAP_POOL_SIZE = int(os.getenv("IMAP_POOL_SIZE", 4))
+
+# Источник писем для разбора отчётов.
+#
+# Любой источник предоставляет:
+#   open() / close()
+#   clone()                             — ещё одно независимое соединение
+#   uidvalidity                         — идентификатор нумерации писем
+#   search(since_uid=None, since=None)  — UID писем (после since_uid или с даты since)
+#   headers(uids)                       — {uid: (заголовки, MIME-части)}
+#   sections(uid, sections)             — {секция: байты части в кодировке из headers()}
+#   stream(uid, section, size)          — те же байты одной секции кусками
+#
+# MIME-часть описывается кортежем (секция, тип, подтип, параметры, кодировка,
+# имя файла, размер) с нумерацией секций как в IMAP.
+
+
+class ImapSource:
+    """Почтовый ящик на IMAP-сервере"""
+
+    def __init__(self, mail=None, folder='inbox'):
+        self.mail = mail
+        self.folder = folder
+        self.uidvalidity = 0
+        self._own_session = mail is None
+
+    def clone(self):
+        return ImapSource(folder=self.folder)
+
+    def open(self):
+        if self.mail is None:
+            self.mail = connect_to_email()
+        self.mail.select(self.folder)
+        _, data = self.mail.response('UIDVALIDITY')
+        self.uidvalidity = int(data[0]) if data and data[0] else 0
+
+    def close(self):
+        if self._own_session and self.mail is not None:
+            try:
+                self.mail.logout()
+            except Exception:
+                pass
+            self.mail = None
+
+    def search(self, since_uid=None, since=None):
+        if since_uid is not None:
+            # "n:*" всегда возвращает хотя бы последний UID, даже если он меньше n
+            uids = search_uids(self.mail, 'UID', f'{since_uid + 1}:*')
+            return [u for u in uids if u > since_uid]
+        if since is not None:
+            return search_uids(self.mail, 'SINCE', since.strftime("%d-%b-%Y"))
+        return search_uids(self.mail, 'ALL')
+
+    def headers(self, uids):
+        return {
+            uid: (headers, list(walk_structure(structure)))
+            for uid, (headers, structure) in fetch_headers(self.mail, uids).items()
+        }
+
+    def sections(self, uid, sections):
+        return fetch_sections(self.mail, uid, sections)
+
+    def stream(self, uid, section, size=0):
+        return fetch_section_chunks(self.mail, uid, section, size)
+
+
+class FolderSource:
+    """Архив писем на диске: каталог Maildir (cur/, new/) или папка с файлами .eml.
+
+    Письма нумеруются по дате (заголовок Date) начиная с 1.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.uidvalidity = zlib.crc32(self.path.encode())
+        self._files = {}
+        self._dates = {}
+
+    def _list_files(self):
+        if os.path.isdir(os.path.join(self.path, 'cur')):
+            dirs = [os.path.join(self.path, d) for d in ('cur', 'new')]
+            return [
+                os.path.join(d, f) for d in dirs if os.path.isdir(d)
+                for f in os.listdir(d) if not f.startswith('.')
+            ]
+        return [
+            os.path.join(root, f)
+            for root, _, files in os.walk(self.path)
+            for f in files if f.lower().endswith('.eml')
+        ]
+
+    def clone(self):
+        # чтение файлов не требует отдельного соединения
+        return self
+
+    def open(self):
+        if self._files:
+            return
+        parser = BytesHeaderParser()
+        dated = []
+        for path in self._list_files():
+            with open(path, 'rb') as f:
+                headers = parser.parse(f)
+            try:
+                date = parsedate_to_datetime(headers['Date']).replace(tzinfo=None)
+            except (TypeError, ValueError):
+                date = datetime.fromtimestamp(os.path.getmtime(path))
+            dated.append((date, path))
+        dated.sort()
+        self._files = {uid: path for uid, (_, path) in enumerate(dated, start=1)}
+        self._dates = {uid: date for uid, (date, _) in enumerate(dated, start=1)}
+
+    def close(self):
+        pass
+
+    def search(self, since_uid=None, since=None):
+        return [
+            uid for uid in self._files
+            if (since_uid is None or uid > since_uid)
+            and (since is None or self._dates[uid] >= since)
+        ]
+
+    def _read(self, uid):
+        with open(self._files[uid], 'rb') as f:
+            return email.message_from_binary_file(f)
+
+    def headers(self, uids):
+        result = {}
+        for uid in uids:
+            msg = self._read(uid)
+            parts = [
+                (section, part.get_content_maintype(), part.get_content_subtype(),
+                 {k.lower(): v for k, v in (part.get_params() or [])[1:]},
+                 'binary',  # sections() отдаёт уже декодированные данные
+                 decode_mime_words(part.get_filename()),
+                 0)
+                for section, part in _walk_message(msg)
+            ]
+            # храним только нужные заголовки, а не всё письмо
+            headers = email.message.Message()
+            for key in ('Subject', 'Date'):
+                if msg[key] is not None:
+                    headers[key] = msg[key]
+            result[uid] = (headers, parts)
+        return result
+
+    def sections(self, uid, sections):
+        parts = dict(_walk_message(self._read(uid)))
+        return {s: parts[s].get_payload(decode=True) or b'' for s in sections if s in parts}
+
+    def stream(self, uid, section, size=0):
+        data = self.sections(uid, [section]).get(section, b'')
+        for i in range(0, len(data), STREAM_CHUNK):
+            yield data[i:i + STREAM_CHUNK]
+
+
+def _walk_message(msg, prefix=''):
+    """Листовые части письма с номерами секций как в IMAP"""
+    if msg.is_multipart():
+        for n, part in enumerate(msg.get_payload(), start=1):
+            yield from _walk_message(part, f"{prefix}{n}.")
+    else:
+        yield (prefix.rstrip('.') or '1'), msg
+
+
+class SourcePool:
+    """Пул соединений одного источника для параллельной загрузки.
+
+    Исходный источник входит в пул; дополнительные соединения (clone())
+    открываются по мере необходимости, не больше `size` всего. Пока идёт
+    map(), исходный источник нельзя использовать вне пула. Соединение, на
+    котором задание упало, в пул не возвращается: вместо него при следующем
+    запросе открывается новое.
+    """
+
+    def __init__(self, source, size=IMAP_POOL_SIZE):
+        self.source = source
+        self.size = max(1, size)
+        self._idle = queue.Queue()
+        self._idle.put(source)
+        self._opened = []
+        self._count = 1
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        # None в очереди — свободное место, на котором нужно открыть соединение
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                grow = self._count < self.size
+                if grow:
+                    self._count += 1
+            conn = None if grow else self._idle.get()
+        if conn is not None:
+            return conn
+        conn = self.source.clone()
+        try:
+            conn.open()
+        except Exception:
+            self._idle.put(None)
+            raise
+        with self._lock:
+            self._opened.append(conn)
+        return conn
+
+    def _discard(self, conn):
+        """Закрывает соединение после ошибки: оно может остаться посреди ответа сервера"""
+        if conn is not self.source:
+            with self._lock:
+                self._opened.remove(conn)
+            try:
+                conn.close()
+            except Exception as e:
+                logging.warning(f"Не удалось закрыть соединение: {e}")
+        # исходный источник закрывает владелец, в пул он больше не попадает
+        self._idle.put(None)
+
+    def run(self, fn, *args):
+        conn = self._acquire()
+        try:
+            result = fn(conn, *args)
+        except BaseException:
+            self._discard(conn)
+            raise
+        self._idle.put(conn)
+        return result
+
+    def map(self, fn, jobs):
+        """fn(источник, job) для каждого job параллельно; результаты — в порядке jobs.
+
+        Одновременно выполняется не больше 2*size заданий, так что первый
+        результат можно обрабатывать, пока остальные ещё скачиваются. При
+        ошибке задания вместо результата возвращается None.
+        """
+        def task(job):
+            try:
+                return self.run(fn, job)
+            except Exception as e:
+                logging.error(f"❌ Ошибка загрузки письма: {e}")
+                return None
+
+        jobs = iter(jobs)
+        with ThreadPoolExecutor(self.size) as executor:
+            futures = deque(executor.submit(task, job) for _, job in zip(range(2 * self.size), jobs))
+            while futures:
+                result = futures.popleft().result()
+                for job in jobs:
+                    futures.append(executor.submit(task, job))
+                    break
+                yield result
+
+    def close(self):
+        for conn in self._opened:
+            if conn is not self.source:
+                conn.close()
+        self._opened = []
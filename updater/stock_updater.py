@@ -1,146 +1,142 @@
 import os
 import pandas as pd
-import sqlite3
 from datetime import datetime
-import imaplib
-import email
-from email.header import decode_header
 import re
 from dotenv import load_dotenv
-import numpy as np
-from openpyxl import load_workbook
 import streamlit as st
 import locale
 
+from updater import analytics, db
+from updater.cache import CacheWriter, iter_cached
+from updater.excel import Layout, iter_report
+from updater.inbox import report_handler, ingest_inbox
+
 # Загрузка переменных окружения
 load_dotenv()
 DB_PATH = os.getenv("DB_PATH", "db.db")
 
 
-def get_email_credentials():
-    email_user = os.getenv("EMAIL_USER")
-    email_password = os.getenv("EMAIL_PASSWORD")
-    email_server = os.getenv("EMAIL_SERVER", "imap.gmail.com")
-    if not all([email_user, email_password, email_server]):
-        raise RuntimeError("Не найдены переменные окружения EMAIL_USER, EMAIL_PASSWORD или EMAIL_SERVER")
-    return email_user, email_password, email_server
-
-
-def connect_to_email():
-    user, password, server = get_email_credentials()
-    mail = imaplib.IMAP4_SSL(server)
-    mail.login(user, password)
-    return mail
-
-
-def get_latest_stock_excel():
-    mail = connect_to_email()
-    mail.select('inbox')
-    _, messages = mail.search(None, 'SINCE', (datetime.now() - pd.Timedelta(days=14)).strftime("%d-%b-%Y"))
-    if not messages[0]:
-        return None, None
-
-    for email_id in messages[0].split()[::-1][:10]:
-        _, msg_data = mail.fetch(email_id, '(RFC822)')
-        msg = email.message_from_bytes(msg_data[0][1])
-        subject, encoding = decode_header(msg['Subject'])[0]
-        if isinstance(subject, bytes):
-            subject = subject.decode(encoding or 'utf-8')
-        if "ведомость" in subject.lower() or "склад на от" in subject.lower():
-            for part in msg.walk():
-                if part.get_content_maintype() == 'multipart':
-                    continue
-                if not part.get('Content-Disposition'):
-                    continue
-                filename, enc = decode_header(part.get_filename())[0]
-                if isinstance(filename, bytes):
-                    filename = filename.decode(enc or 'utf-8')
-                if filename.lower().endswith(('.xlsx', '.xls')):
-                    os.makedirs('temp', exist_ok=True)
-                    path = os.path.join('temp', filename)
-                    with open(path, 'wb') as f:
-                        f.write(part.get_payload(decode=True))
-
-                    body = ""
-                    if msg.is_multipart():
-                        for p in msg.walk():
-                            if p.get_content_type() == "text/plain":
-                                body = p.get_payload(decode=True).decode(p.get_content_charset() or 'utf-8', 'ignore')
-                                break
-                    else:
-                        body = msg.get_payload(decode=True).decode(msg.get_content_charset() or 'utf-8', 'ignore')
-
-                    m = re.search(r"(\d{1,2} \w+ \d{4} г\.)", body)
-                    report_date = m.group(1) if m else datetime.now().strftime("%Y-%m-%d")
-                    return path, report_date
-    return None, None
-
+@report_handler('stock', 'ведомость', 'склад на от', days=14, body=True)
+def handle_stock_report(report):
+    m = re.search(r"(\d{1,2} \w+ \d{4} г\.)", report.body)
+    report_date = m.group(1) if m else datetime.now().strftime("%Y-%m-%d")
 
-def process_stock_excel(filepath, report_date=None):
-    warehouse_map = {
-        'СТН Склад ТМЦ': 'Склад (материалы)',
-        'СТН Кладовая уч.кабельных изделий': 'Склад (материалы)',
-        'Склад МОСКВА (ООО СТН)': 'Склад Готовой продукции',
-        'Склад ВЛАДИМИР (Автоприбор)': 'Склад Готовой продукции',
-        'СТН Склад гот.изделий': 'Склад Готовой продукции',
-        'Склад НТЗ': 'Склад НТЗ'
-    }
-
-    wb = load_workbook(filepath, data_only=True)
-    ws = wb.active
-    data = [row for row in ws.iter_rows(min_row=2, values_only=True)]
-    df = pd.DataFrame(data, columns=[
-        'Артикул', 'Номенклатура', 'Номенклатура.Вид номенклатуры',
-        'Склад', 'Количество конечный остаток', 'Оценка (конечный остаток)'
-    ])
-
-    df.rename(columns={
+    rows = update_stock_db(iter_stock_batches(report.path, report_date, report.sha256))
+    if not rows:
+        return False
+    return report_date, rows
+
+
+STOCK_COLUMNS = [
+    'Артикул', 'Номенклатура', 'Номенклатура.Вид номенклатуры',
+    'Склад', 'Количество конечный остаток', 'Оценка (конечный остаток)'
+]
+STOCK_LAYOUT = Layout(columns=STOCK_COLUMNS, min_row=2)
+# Меняется при любом изменении разбора — старые записи кэша перестают использоваться
+STOCK_PARSER_VERSION = 2
+
+WAREHOUSE_MAP = {
+    'СТН Склад ТМЦ': 'Склад (материалы)',
+    'СТН Кладовая уч.кабельных изделий': 'Склад (материалы)',
+    'Склад МОСКВА (ООО СТН)': 'Склад Готовой продукции',
+    'Склад ВЛАДИМИР (Автоприбор)': 'Склад Готовой продукции',
+    'СТН Склад гот.изделий': 'Склад Готовой продукции',
+    'Склад НТЗ': 'Склад НТЗ'
+}
+
+
+def normalize_stock_df(df):
+    """Переименование и приведение типов (зависит только от содержимого файла)"""
+    df = df.rename(columns={
         'Артикул': 'article',
         'Номенклатура': 'nomenclature',
         'Номенклатура.Вид номенклатуры': 'nomenclature_type',
         'Склад': 'warehouse',
         'Количество конечный остаток': 'quantity',
         'Оценка (конечный остаток)': 'value'
-    }, inplace=True)
+    })
 
-    df['warehouse'] = df['warehouse'].map(lambda x: warehouse_map.get(str(x).strip(), x))
+    df['warehouse'] = df['warehouse'].map(lambda x: WAREHOUSE_MAP.get(str(x).strip(), x))
     df['quantity'] = pd.to_numeric(df['quantity'], errors='coerce').fillna(0)
     df['value'] = pd.to_numeric(df['value'], errors='coerce').fillna(0)
+    return df
+
+
+def clean_stock_df(df, report_date=None):
+    df = normalize_stock_df(df)
     df['date_updated'] = datetime.now()
     df['report_date'] = report_date or datetime.now().strftime('%Y-%m-%d')
     return df
 
 
+def iter_stock_batches(filepath, report_date=None, sha256=None):
+    """Очищенные пачки строк складской ведомости (потоковое чтение книги).
+
+    Если известен sha256 вложения, нормализованные строки берутся из кэша
+    разобранных отчётов или сохраняются в него.
+    """
+    cached = iter_cached('stock', STOCK_PARSER_VERSION, sha256)
+    if cached is not None:
+        for batch in cached:
+            batch['date_updated'] = datetime.now()
+            batch['report_date'] = report_date or datetime.now().strftime('%Y-%m-%d')
+            yield batch
+        return
+
+    writer = CacheWriter('stock', STOCK_PARSER_VERSION, sha256)
+    ok = False
+    try:
+        for batch in iter_report(filepath, STOCK_LAYOUT):
+            batch = normalize_stock_df(batch)
+            writer.write(batch)
+            batch['date_updated'] = datetime.now()
+            batch['report_date'] = report_date or datetime.now().strftime('%Y-%m-%d')
+            yield batch
+        ok = True
+    finally:
+        writer.close(ok)
+
+
+def process_stock_excel(filepath, report_date=None):
+    batches = list(iter_stock_batches(filepath, report_date))
+    if not batches:
+        return clean_stock_df(pd.DataFrame(columns=STOCK_COLUMNS), report_date)
+    return pd.concat(batches, ignore_index=True)
+
+
 def update_stock_db(df):
-    if df is None or df.empty:
-        return False
+    """Записывает остатки (DataFrame или итератор пачек) одной транзакцией.
+
+    Пачки сначала разбираются во временную таблицу, затем остатки на даты
+    отчёта, загруженные ранее, заменяются в короткой транзакции. Возвращает
+    число записанных строк.
+    """
+    batches = [df] if isinstance(df, pd.DataFrame) else df
+    rows = 0
+    dates = set()
     try:
-        conn = sqlite3.connect(DB_PATH)
-        df.to_sql('stock_balance', conn, if_exists='append', index=False)
-        conn.commit()
-        conn.close()
-        return True
+        conn = db.get_connection(DB_PATH)
+        with db.staging(conn, 'stock_balance') as staged:
+            for batch in batches:
+                if batch is None or batch.empty:
+                    continue
+                dates |= set(batch['report_date'].unique())
+                db.insert_df(conn, staged, batch, immediate=False)
+                rows += len(batch)
+            if not rows:
+                return 0
+            with db.transaction(conn, immediate=True):
+                db.delete_partitions(conn, 'stock_balance', ['report_date'], [(d,) for d in dates])
+                db.insert_staged(conn, 'stock_balance', staged)
+        analytics.store('stock_balance', [(d,) for d in dates], DB_PATH)
+        return rows
     except Exception as e:
         print(f"Ошибка при обновлении базы данных: {e}")
-        return False
+        return 0
 
 
 def update_stock_data():
-    excel_file, report_date = get_latest_stock_excel()
-    if not excel_file:
-        print("Не найдено писем с Excel-файлами")
-        return False
-
-    df = process_stock_excel(excel_file, report_date)
-    if df is None:
-        return False
-
-    success = update_stock_db(df)
-    try:
-        os.remove(excel_file)
-    except:
-        pass
-    return success
+    return ingest_inbox(['stock'])['stock']
 
 
 def show_stale_stock():
@@ -152,9 +148,7 @@ def show_stale_stock():
 
     update_stock_data()
 
-    conn = sqlite3.connect(DB_PATH)
-    dates_df = pd.read_sql_query("SELECT DISTINCT report_date FROM stock_balance ORDER BY report_date DESC", conn)
-    conn.close()
+    dates_df = db.query_df("SELECT DISTINCT report_date FROM stock_balance ORDER BY report_date DESC")
 
     dates_df['report_date'] = pd.to_datetime(dates_df['report_date'])
     formatted_labels = dates_df['report_date'].dt.strftime('%-d %B %Y').str.capitalize()
@@ -165,14 +159,12 @@ def show_stale_stock():
 
     st.markdown(f"📅 **Отображаются данные за дату: {selected_label}**")
 
-    conn = sqlite3.connect(DB_PATH)
     query = """
     SELECT article, nomenclature, warehouse, quantity, report_date
     FROM stock_balance
     WHERE quantity > 0 AND report_date = ?
     """
-    df = pd.read_sql_query(query, conn, params=(selected_date.strftime('%Y-%m-%d'),))
-    conn.close()
+    df = db.query_df(query, (selected_date.strftime('%Y-%m-%d'),))
 
     df['report_date'] = pd.to_datetime(df['report_date'])
     current_date = df['report_date'].max()